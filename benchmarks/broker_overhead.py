@@ -0,0 +1,77 @@
+# -*- coding: utf-8 -*-
+# Copyright (C) 2012 Oskar Skoog. Released under GPL.
+
+"""Measure the per-call overhead added by the LysKOM socket broker.
+
+A broker is started in a thread with sessions that answer without any
+LysKOM server, so the difference between the direct and the remote
+calls is the cost of the IPC (pickling, Unix socket round trip and
+dispatch in the broker).
+
+  python benchmarks/broker_overhead.py [--calls 20000]
+"""
+
+from __future__ import absolute_import, print_function
+import argparse
+import os
+import tempfile
+import threading
+import time
+
+from httpkom.broker import BrokerClient, KomSessionBroker, RemoteKomSession
+
+
+class _Membership(object):
+    def __init__(self, conf_no):
+        self.pers_no = 14506
+        self.conf_no = conf_no
+        self.priority = 100
+        self.unread_texts = list(range(19680717, 19680717 + 20))
+
+
+class _LocalSession(object):
+    def connect(self, *args, **kwargs):
+        pass
+
+    def who_am_i(self):
+        return 4711
+
+    def get_membership_unreads(self, pers_no):
+        return [ _Membership(conf_no) for conf_no in range(50) ]
+
+
+def _time_calls(method, calls, *args):
+    start = time.time()
+    for _ in range(calls):
+        method(*args)
+    return (time.time() - start) / calls
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark broker IPC overhead.')
+    parser.add_argument('--calls', type=int, default=20000)
+    args = parser.parse_args()
+
+    path = os.path.join(tempfile.mkdtemp(), 'broker.sock')
+    broker = KomSessionBroker(path, session_factory=_LocalSession)
+    thread = threading.Thread(target=broker.serve_forever)
+    thread.daemon = True
+    thread.start()
+    while not os.path.exists(path):
+        time.sleep(0.01)
+
+    local = _LocalSession()
+    remote = RemoteKomSession(BrokerClient(path), 'bench')
+    remote.connect()
+
+    for name, call_args in [ ('who_am_i', ()), ('get_membership_unreads', (14506,)) ]:
+        direct = _time_calls(getattr(local, name), args.calls, *call_args)
+        via_broker = _time_calls(getattr(remote, name), args.calls, *call_args)
+        print("%-24s direct: %8.2f us  broker: %8.2f us  overhead: %8.2f us/call" % (
+            name, direct * 1e6, via_broker * 1e6, (via_broker - direct) * 1e6))
+
+    broker.shutdown()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,91 @@
+# -*- coding: utf-8 -*-
+# Copyright (C) 2012 Oskar Skoog. Released under GPL.
+
+"""Compare name expansion in the local name index with lookup_name
+calls to a LysKOM server.
+
+Without --host, the index is built from generated names and only the
+index is measured. With --host, the index is built from the server's
+names and the same patterns are also looked up on the server.
+
+  python benchmarks/name_index.py [--names 30000] [--calls 2000]
+  python benchmarks/name_index.py --host kom.lysator.liu.se
+"""
+
+from __future__ import absolute_import, print_function
+import argparse
+import random
+import socket
+import time
+
+from httpkom.nameindex import NameIndex
+
+
+_PATTERNS = [ u'o', u'osk', u'osk t', u'lysk', u'lysator (', u'k s', u'' ]
+
+_WORDS = [ u'Oskar', u'Skoog', u'Testperson', u'LysKOM', u'Lysator', u'Kalle', u'Svensson',
+           u'Anka', u'tredje', u'person', u'Inlägg', u'Åt', u'mig', u'Bugg', u'rapporter',
+           u'Föreningen', u'Kom', u'Elisp', u'klient', u'möten' ]
+
+
+def _generated_entries(count):
+    rnd = random.Random(4711)
+    entries = []
+    for conf_no in range(1, count + 1):
+        name = u' '.join(rnd.choice(_WORDS) for _ in range(rnd.randint(1, 4)))
+        if rnd.random() < 0.2:
+            name += u' (%s)' % rnd.choice(_WORDS)
+        entries.append((conf_no, name, rnd.random() < 0.7))
+    return entries
+
+def _server_entries(ksession):
+    return [ (conf_no, name, True) for conf_no, name in ksession.lookup_name(u'', True, False) ] + \
+           [ (conf_no, name, False) for conf_no, name in ksession.lookup_name(u'', False, True) ]
+
+
+def _time_calls(func, calls, *args):
+    start = time.time()
+    for _ in range(calls):
+        func(*args)
+    return (time.time() - start) / calls
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the name index.')
+    parser.add_argument('--names', type=int, default=30000)
+    parser.add_argument('--calls', type=int, default=2000)
+    parser.add_argument('--host', default=None)
+    parser.add_argument('--port', type=int, default=4894)
+    args = parser.parse_args()
+
+    ksession = None
+    if args.host is None:
+        entries = _generated_entries(args.names)
+    else:
+        from pylyskom.komsession import KomSession
+        ksession = KomSession()
+        ksession.connect(args.host, args.port, "httpkom", socket.getfqdn(),
+                         "httpkom-benchmark", "0")
+        entries = _server_entries(ksession)
+
+    index = NameIndex()
+    start = time.time()
+    index.build(entries)
+    print("built index of %d names in %.2f ms" % (len(entries), (time.time() - start) * 1e3))
+
+    for pattern in _PATTERNS:
+        matches = len(index.lookup(pattern, True, True))
+        local = _time_calls(index.lookup, args.calls, pattern, True, True)
+        line = "%-12r %6d matches  index: %10.2f us" % (pattern, matches, local * 1e6)
+        if ksession is not None:
+            calls = max(1, args.calls // 100)
+            remote = _time_calls(ksession.lookup_name, calls, pattern, True, True)
+            line += "  lookup_name: %10.2f us" % (remote * 1e6,)
+        print(line)
+
+    if ksession is not None:
+        ksession.disconnect(0)
+
+
+if __name__ == "__main__":
+    main()
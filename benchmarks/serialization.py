@@ -0,0 +1,130 @@
+# -*- coding: utf-8 -*-
+# Copyright (C) 2012 Oskar Skoog. Released under GPL.
+
+"""Compare to_dict with the type registry against the chain of
+isinstance checks it replaced, on texts and memberships that look
+like the ones clients get (without lookups, so no LysKOM server is
+needed). Also checks that both give the same result.
+
+  python benchmarks/serialization.py [--rounds 200]
+"""
+
+from __future__ import absolute_import, print_function
+import argparse
+import time
+
+from pylyskom import datatypes, komauxitems
+from pylyskom.komsession import (KomPerson, KomText, KomConference, KomUConference,
+                                 KomMembership, KomMembershipUnread)
+
+from httpkom import komserialization
+from httpkom.komserialization import to_dict
+
+
+def _isinstance_to_dict(obj, lookups, session, fields=None):
+    ks = komserialization
+    if obj is None:
+        return None
+    elif isinstance(obj, list) or isinstance(obj, tuple):
+        return [ _isinstance_to_dict(el, lookups, session) for el in obj ]
+    elif isinstance(obj, KomPerson):
+        return ks.KomPerson_to_dict(obj, lookups, session)
+    elif isinstance(obj, KomText):
+        return ks.KomText_to_dict(obj, lookups, session)
+    elif isinstance(obj, datatypes.MIRecipient):
+        return ks.MIRecipient_to_dict(obj, lookups, session)
+    elif isinstance(obj, datatypes.MICommentTo):
+        return ks.MICommentTo_to_dict(obj, lookups, session)
+    elif isinstance(obj, datatypes.MICommentIn):
+        return ks.MICommentIn_to_dict(obj, lookups, session)
+    elif isinstance(obj, KomConference):
+        return ks.KomConference_to_dict(obj, lookups, session)
+    elif isinstance(obj, KomUConference):
+        return ks.KomUConference_to_dict(obj, lookups, session)
+    elif isinstance(obj, datatypes.ConfType):
+        return ks.ConfType_to_dict(obj, lookups, session)
+    elif isinstance(obj, KomMembership):
+        return ks.KomMembership_to_dict(obj, lookups, session)
+    elif isinstance(obj, KomMembershipUnread):
+        return ks.KomMembershipUnread_to_dict(obj, lookups, session)
+    elif isinstance(obj, datatypes.MembershipType):
+        return ks.MembershipType_to_dict(obj, lookups, session)
+    elif isinstance(obj, datatypes.AuxItem):
+        return ks.AuxItem_to_dict(obj, lookups, session)
+    elif isinstance(obj, datatypes.Mark):
+        return ks.Mark_to_dict(obj, lookups, session)
+    elif isinstance(obj, datatypes.Time):
+        return ks.Time_to_dict(obj, lookups, session)
+    else:
+        return obj
+
+
+def _new(cls, **attrs):
+    # Avoid depending on the constructors, only the attributes are used.
+    obj = cls.__new__(cls)
+    obj.__dict__.update(attrs)
+    return obj
+
+def _time():
+    return _new(datatypes.Time, seconds=6, minutes=58, hours=15, day=30, month=10, year=113,
+                day_of_week=6, day_of_year=333, is_dst=0)
+
+def _text(text_no):
+    return _new(KomText, text_no=text_no, author=14506, no_of_marks=1,
+                content_type='text/x-kom-basic', subject=u'jaha', body=u'räksmörgås\n' * 20,
+                creation_time=_time(),
+                recipient_list=[ _new(datatypes.MIRecipient, type=datatypes.MIR_TO, recpt=conf_no,
+                                      loc_no=text_no % 1000, sent_by=None, sent_at=None,
+                                      rec_time=None)
+                                 for conf_no in (14506, 6) ],
+                comment_to_list=[ _new(datatypes.MICommentTo, type=datatypes.MIC_COMMENT,
+                                       text_no=text_no - 1) ],
+                comment_in_list=[ _new(datatypes.MICommentIn, type=datatypes.MIC_COMMENT,
+                                       text_no=text_no + i) for i in range(1, 4) ],
+                aux_items=[ _new(datatypes.AuxItem, aux_no=1, tag=komauxitems.AI_FAST_REPLY,
+                                 creator=14506, created_at=_time(),
+                                 flags=_new(datatypes.AuxItemFlags, deleted=0, inherit=0,
+                                            secret=0, hide_creator=0, dont_garb=0),
+                                 inherit_limit=0, data=b'ja'),
+                            _new(datatypes.AuxItem, aux_no=2, tag=komauxitems.AI_CREATING_SOFTWARE,
+                                 creator=14506, created_at=_time(), flags=None,
+                                 inherit_limit=0, data=b'jskom') ])
+
+def _membership(conf_no):
+    return _new(KomMembership, pers_no=14506, position=conf_no, last_time_read=_time(),
+                conference=conf_no, priority=100, added_by=14506, added_at=_time(),
+                type=_new(datatypes.MembershipType, invitation=0, passive=0, secret=0,
+                          passive_message_invert=0))
+
+
+def _time_calls(func, rounds, *args):
+    start = time.time()
+    for _ in range(rounds):
+        func(*args)
+    return (time.time() - start) / rounds
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark komserialization.to_dict.')
+    parser.add_argument('--rounds', type=int, default=200)
+    args = parser.parse_args()
+
+    graphs = [ ('50 texts', [ _text(19680717 + i) for i in range(50) ]),
+               ('200 memberships', [ _membership(conf_no) for conf_no in range(200) ]) ]
+    registry_to_dict = komserialization._to_dict
+    for name, graph in graphs:
+        registry = _time_calls(to_dict, args.rounds, graph)
+        registry_result = to_dict(graph)
+        # The *_to_dict functions call _to_dict for nested objects.
+        komserialization._to_dict = _isinstance_to_dict
+        try:
+            chain = _time_calls(to_dict, args.rounds, graph)
+            same = to_dict(graph) == registry_result
+        finally:
+            komserialization._to_dict = registry_to_dict
+        print("%-16s isinstance chain: %8.1f us  registry: %8.1f us  speedup: %.2fx  same: %s" % (
+            name, chain * 1e6, registry * 1e6, chain / registry, same))
+
+
+if __name__ == "__main__":
+    main()
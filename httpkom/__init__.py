@@ -6,7 +6,7 @@ import os
 import logging
 from logging.handlers import TimedRotatingFileHandler
 
-from flask import Flask, Blueprint, request, jsonify, g, abort
+from flask import Flask, Blueprint, request, g, abort
 import six
 
 
@@ -27,12 +27,85 @@ class default_settings:
     HTTPKOM_CROSSDOMAIN_ALLOWED_ORIGINS = '*'
     HTTPKOM_CROSSDOMAIN_MAX_AGE = 0
     HTTPKOM_CROSSDOMAIN_ALLOW_HEADERS = [ 'Origin', 'Accept', 'Content-Type', 'X-Requested-With',
-                                          'Cache-Control' ]
-    HTTPKOM_CROSSDOMAIN_EXPOSE_HEADERS = [ 'Cache-Control' ]
+                                          'Cache-Control', 'If-None-Match' ]
+    HTTPKOM_CROSSDOMAIN_EXPOSE_HEADERS = [ 'Cache-Control', 'ETag' ]
     HTTPKOM_CROSSDOMAIN_ALLOW_METHODS = [ 'GET', 'POST', 'PUT', 'DELETE', 'OPTIONS', 'HEAD' ]
 
     PRESERVE_CONTEXT_ON_EXCEPTION = False
 
+    # Path to the Unix socket of a httpkom.broker process that owns
+    # the LysKOM connections. None means that the connections are
+    # owned by this process.
+    HTTPKOM_BROKER_SOCKET = None
+
+    # Sessions that have not been used for this many seconds are
+    # disconnected. None means never.
+    HTTPKOM_SESSION_IDLE_TIMEOUT = None
+    # Max number of sessions. When there are more, the least recently
+    # used sessions are disconnected. None means no limit.
+    HTTPKOM_MAX_SESSIONS = None
+    # How often (in seconds) to look for idle sessions.
+    HTTPKOM_SESSION_REAPER_INTERVAL = 60
+
+    # Number of connected, not logged in, sessions to keep ready for
+    # each server and client (name and version). 0 disables the pools.
+    HTTPKOM_SESSION_POOL_SIZE = 2
+    # Pooled sessions older than this (in seconds) are replaced.
+    HTTPKOM_SESSION_POOL_MAX_AGE = 10 * 60
+    # Max number of different clients to keep pools for.
+    HTTPKOM_SESSION_POOL_MAX_CLIENTS = 10
+
+    # Number of shared, not logged in, sessions per server, used for
+    # requests without a Httpkom-Connection (for example name
+    # lookups).
+    HTTPKOM_SHARED_SESSIONS_PER_SERVER = 2
+
+    # Share one LysKOM session between all connection ids that are
+    # logged in as the same person (todo.txt, Förslag B). Not
+    # supported together with HTTPKOM_BROKER_SOCKET.
+    HTTPKOM_SHARE_PERSON_SESSIONS = False
+
+    # Max number of threads (shared by all batch requests) that run
+    # the GET and HEAD sub-requests of POST /batch concurrently.
+    HTTPKOM_BATCH_MAX_WORKERS = 8
+
+    # Conference name cache shared by all sessions to a server.
+    HTTPKOM_NAME_CACHE_TTL = 60 * 60
+    HTTPKOM_NAME_CACHE_MAX_BYTES = 4 * 1024 * 1024
+
+    # Cache of the contents of public texts shared by all sessions to
+    # a server. 0 disables the cache.
+    HTTPKOM_TEXT_CACHE_MAX_BYTES = 32 * 1024 * 1024
+
+    # Answer conference name lookups from a local index per server,
+    # rebuilt every HTTPKOM_NAME_INDEX_REFRESH seconds (renames are
+    # applied as they happen). Secret conferences are never found
+    # through the index.
+    HTTPKOM_NAME_INDEX = False
+    HTTPKOM_NAME_INDEX_REFRESH = 10 * 60
+
+    # Keep track of the logged in person's unread texts with async
+    # messages, and fetch them from the server again at least this
+    # often (seconds). Texts read by the person's other sessions are
+    # only noticed then. 0 always asks the server.
+    HTTPKOM_UNREAD_RESYNC_INTERVAL = 0
+
+    # JSON library for responses: 'orjson', 'rapidjson', 'ujson' or
+    # 'json'. None uses the fastest one that is installed.
+    HTTPKOM_JSON_BACKEND = None
+
+    # Compress responses with brotli (if installed) or gzip, when the
+    # client accepts it. Only responses with the content types below
+    # ('type/*' matches all subtypes), and at least MIN_SIZE bytes
+    # (unless streamed), are compressed. The level is for gzip (1-9),
+    # brotli uses HTTPKOM_BROTLI_QUALITY (0-11).
+    HTTPKOM_COMPRESSION = True
+    HTTPKOM_COMPRESSION_LEVEL = 6
+    HTTPKOM_BROTLI_QUALITY = 5
+    HTTPKOM_COMPRESSION_MIN_SIZE = 1024
+    HTTPKOM_COMPRESSION_MIMETYPES = [ 'application/json', 'application/x-ndjson', 'text/*',
+                                      'x-kom/user-area' ]
+
 
 app = Flask(__name__)
 app.config.from_object(default_settings)
@@ -93,6 +166,8 @@ if not app.debug and app.config['LOG_FILE'] is not None:
 
 
 
+from .jsonresponse import jsonify
+
 # Load app parts
 from . import conferences
 from . import sessions
@@ -101,6 +176,8 @@ from . import persons
 from . import memberships
 from . import errors
 from . import stats
+from . import batch
+from . import compression
 
 # to avoid pyflakes errors
 dir(conferences)
@@ -110,6 +187,8 @@ dir(persons)
 dir(memberships)
 dir(errors)
 dir(stats)
+dir(batch)
+dir(compression)
 
 
 app.register_blueprint(bp)
@@ -0,0 +1,164 @@
+# -*- coding: utf-8 -*-
+# Copyright (C) 2012 Oskar Skoog. Released under GPL.
+
+"""ASGI front end for httpkom: a plain ASGI-to-WSGI bridge.
+
+The HTTP connections are handled by an asyncio event loop (for
+example uvicorn), so idle and slow HTTP clients only cost coroutines.
+The requests are dispatched to the regular Flask app (the same
+blueprint routes and serialization as in the WSGI mode), which runs in
+a bounded pool of worker threads. The LysKOM sessions are not async:
+pylyskom's KomSession does blocking socket I/O, so every LysKOM call
+still blocks a worker thread, exactly as with the CherryPy front end,
+and the responses are identical.
+
+Note that open LysKOM sessions do not use any threads in either mode;
+a thread is only used while a request is being served.
+
+Requires Python 3.7.
+"""
+
+import asyncio
+import io
+import sys
+from concurrent.futures import ThreadPoolExecutor
+
+
+class AsgiApp(object):
+    """Adapter that serves a WSGI app as an ASGI (version 3) app,
+    running the WSGI app in a thread pool.
+    """
+    def __init__(self, wsgi_app, max_workers=10):
+        self._wsgi_app = wsgi_app
+        self._executor = ThreadPoolExecutor(max_workers=max_workers)
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] == 'lifespan':
+            await self._lifespan(receive, send)
+        elif scope['type'] == 'http':
+            await self._http(scope, receive, send)
+        # Other scope types (websocket) are not supported, and the
+        # server closes those connections when we return.
+
+    async def _lifespan(self, receive, send):
+        while True:
+            message = await receive()
+            if message['type'] == 'lifespan.startup':
+                await send({ 'type': 'lifespan.startup.complete' })
+            elif message['type'] == 'lifespan.shutdown':
+                self._executor.shutdown(wait=False)
+                await send({ 'type': 'lifespan.shutdown.complete' })
+                return
+
+    async def _http(self, scope, receive, send):
+        body = await _read_body(receive)
+        environ = _build_environ(scope, body)
+        loop = asyncio.get_running_loop()
+        # The worker thread puts the messages to send in the queue
+        # (None when done), so streamed responses are sent as they
+        # are produced. The thread doesn't wait for slow clients.
+        messages = asyncio.Queue()
+        def put(message):
+            loop.call_soon_threadsafe(messages.put_nowait, message)
+        worker = loop.run_in_executor(
+            self._executor, _call_wsgi_app, self._wsgi_app, environ, put)
+
+        while True:
+            message = await messages.get()
+            if message is None:
+                break
+            await send(message)
+        await worker
+
+
+async def _read_body(receive):
+    body = []
+    more_body = True
+    while more_body:
+        message = await receive()
+        if message['type'] == 'http.disconnect':
+            break
+        body.append(message.get('body', b''))
+        more_body = message.get('more_body', False)
+    return b''.join(body)
+
+
+def _build_environ(scope, body):
+    server = scope.get('server') or ('localhost', 80)
+    client = scope.get('client') or ('', 0)
+    # PEP 3333: native strings containing the raw bytes as latin-1.
+    path = scope.get('raw_path') or scope['path'].encode('utf-8')
+    root_path = scope.get('root_path', '').encode('utf-8')
+    if root_path and path.startswith(root_path):
+        path = path[len(root_path):]
+
+    environ = {
+        'REQUEST_METHOD': scope['method'],
+        'SCRIPT_NAME': root_path.decode('latin-1'),
+        'PATH_INFO': path.split(b'?', 1)[0].decode('latin-1'),
+        'QUERY_STRING': scope.get('query_string', b'').decode('latin-1'),
+        'SERVER_NAME': server[0],
+        'SERVER_PORT': str(server[1]),
+        'REMOTE_ADDR': client[0],
+        'SERVER_PROTOCOL': 'HTTP/%s' % scope.get('http_version', '1.1'),
+        'wsgi.version': (1, 0),
+        'wsgi.url_scheme': scope.get('scheme', 'http'),
+        'wsgi.input': io.BytesIO(body),
+        'wsgi.errors': sys.stderr,
+        'wsgi.multithread': True,
+        'wsgi.multiprocess': False,
+        'wsgi.run_once': False,
+    }
+
+    for name, value in scope.get('headers', []):
+        name = name.decode('latin-1').upper().replace('-', '_')
+        value = value.decode('latin-1')
+        if name == 'CONTENT_TYPE':
+            key = 'CONTENT_TYPE'
+        elif name == 'CONTENT_LENGTH':
+            key = 'CONTENT_LENGTH'
+        else:
+            key = 'HTTP_' + name
+        if key in environ:
+            value = environ[key] + ',' + value
+        environ[key] = value
+
+    return environ
+
+
+def _call_wsgi_app(wsgi_app, environ, put):
+    """Call the WSGI app and put the ASGI messages for the response,
+    followed by None.
+    """
+    response = {}
+
+    def start_response(status, headers, exc_info=None):
+        if exc_info is not None and 'started' in response:
+            raise exc_info[1].with_traceback(exc_info[2])
+        response['status'] = int(status.split(' ', 1)[0])
+        response['headers'] = headers
+        return write
+
+    def write(chunk):
+        # The headers are sent with the first chunk (PEP 3333).
+        if 'started' not in response:
+            response['started'] = True
+            put({ 'type': 'http.response.start',
+                  'status': response['status'],
+                  'headers': [ (k.encode('latin-1'), v.encode('latin-1'))
+                               for k, v in response['headers'] ] })
+        if chunk:
+            put({ 'type': 'http.response.body', 'body': chunk, 'more_body': True })
+
+    try:
+        result = wsgi_app(environ, start_response)
+        try:
+            for chunk in result:
+                write(chunk)
+            write(b'')
+        finally:
+            if hasattr(result, 'close'):
+                result.close()
+        put({ 'type': 'http.response.body', 'body': b'', 'more_body': False })
+    finally:
+        put(None)
@@ -0,0 +1,207 @@
+# -*- coding: utf-8 -*-
+# Copyright (C) 2012 Oskar Skoog. Released under GPL.
+
+from __future__ import absolute_import
+import base64
+import json
+import threading
+from multiprocessing.pool import ThreadPool
+
+import six
+from flask import g, request
+from werkzeug.exceptions import HTTPException
+from werkzeug.test import EnvironBuilder
+
+from httpkom import HTTPKOM_CONNECTION_HEADER, app, bp
+from .errors import error_response
+from .jsonresponse import NDJSON_MIMETYPE, jsonify
+
+
+# Max number of sub-requests in one batch.
+_MAX_SUB_REQUESTS = 50
+
+# Response headers that only make sense for the batch response itself.
+_SKIPPED_HEADERS = ('content-length', 'access-control-')
+
+
+_pool = None
+_pool_lock = threading.Lock()
+
+def _get_pool():
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            _pool = ThreadPool(app.config['HTTPKOM_BATCH_MAX_WORKERS'])
+        return _pool
+
+
+def _sub_request_environ(server_id, method, path, headers=None, body=None):
+    builder = EnvironBuilder(
+        path='/' + server_id + path, method=method, headers=headers,
+        data=json.dumps(body) if body is not None else None,
+        content_type='application/json' if body is not None else None)
+    return builder.get_environ()
+
+def _is_batch(method, path):
+    # Match the path the same way as when it is dispatched, so that
+    # for example "/bat%63h" is found too.
+    adapter = app.url_map.bind_to_environ(_sub_request_environ(g.server.id, method, path))
+    try:
+        endpoint, values = adapter.match()
+    except HTTPException:
+        return False
+    return endpoint == request.url_rule.endpoint
+
+def _parse_sub_request(sub):
+    if not isinstance(sub, dict):
+        raise ValueError('Sub-request is not an object.')
+    method = sub.get('method', 'GET')
+    if not isinstance(method, six.string_types):
+        raise ValueError('"method" is not a string.')
+    method = method.upper()
+    path = sub.get('path', None)
+    if not isinstance(path, six.string_types) or not path.startswith('/'):
+        raise ValueError('"path" must start with "/".')
+    if _is_batch(method, path):
+        raise ValueError('Batches can not be nested.')
+    headers = sub.get('headers', {})
+    if not isinstance(headers, dict):
+        raise ValueError('"headers" is not an object.')
+    return method, path, headers, sub.get('body', None)
+
+def _response_to_dict(response):
+    headers = dict((k, v) for k, v in response.headers.items()
+                   if not k.lower().startswith(_SKIPPED_HEADERS))
+    result = dict(status=response.status_code, headers=headers, body=None)
+    data = response.get_data()
+    if not data:
+        pass
+    elif response.mimetype == 'application/json':
+        result['body'] = json.loads(data.decode('utf-8'))
+    elif response.mimetype.startswith('text/') or response.mimetype == NDJSON_MIMETYPE:
+        result['body'] = data.decode(response.charset or 'utf-8')
+    else:
+        result['body'] = base64.b64encode(data).decode('ascii')
+        result['body_encoding'] = 'base64'
+    return result
+
+def _dispatch(server_id, connection_id, method, path, headers, body):
+    """Run one sub-request through the app, as if it was a request of
+    its own, and return the response as a dict.
+    """
+    # The sub-responses are put in the batch response, which is
+    # compressed as a whole.
+    headers = dict((k, v) for k, v in headers.items() if k.lower() != 'accept-encoding')
+    if connection_id is not None:
+        headers[HTTPKOM_CONNECTION_HEADER] = connection_id
+    environ = _sub_request_environ(server_id, method, path, headers, body)
+    # A new app context, so the sub-requests don't share g.
+    with app.app_context():
+        try:
+            with app.request_context(environ):
+                return _response_to_dict(app.full_dispatch_request())
+        except Exception as ex:
+            app.logger.exception('Sub-request %s %s failed', method, path)
+            return _response_to_dict(error_response(500, error_msg=str(ex)))
+
+def _dispatch_concurrently(server_id, connection_id, calls):
+    # The first call is run in this thread, the others by the shared
+    # pool (which bounds the number of threads for all batches).
+    pending = [ _get_pool().apply_async(_dispatch, (server_id, connection_id) + tuple(call))
+                for call in calls[1:] ]
+    results = [ _dispatch(server_id, connection_id, *calls[0]) ]
+    results.extend(p.get() for p in pending)
+    return results
+
+
+@bp.route('/batch', methods=['POST'])
+def batch():
+    """Make several requests in one. Each sub-request is handled as a
+    request of its own to the same server, with the same
+    Httpkom-Connection (if any), and the responses are returned in the
+    same order.
+
+    Sub-requests are handled in order, except that consecutive GET and
+    HEAD sub-requests are handled at the same time (their LysKOM calls
+    are then pipelined). Use them for sub-requests that don't depend
+    on each other.
+
+    If a sub-request creates a new session (the response has a
+    Httpkom-Connection header), the following sub-requests use it.
+
+    Each sub-request has a method (default GET), a path (relative to
+    the server, with query string), and optionally headers and a JSON
+    body. Response bodies that are not JSON are returned as strings
+    (base64 encoded, with "body_encoding", if the content type is not
+    text). At most 50 sub-requests are allowed. A sub-request that
+    fails unexpectedly gets a response with status 500.
+
+    .. rubric:: Request
+
+    ::
+
+      POST /<server_id>/batch HTTP/1.1
+      Httpkom-Connection: 033556ee-3e52-423f-9c9a-d85aed7688a1
+
+      [
+        { "method": "GET", "path": "/sessions/current/who-am-i" },
+        { "method": "GET", "path": "/persons/14506/memberships/unread/" },
+        { "method": "GET", "path": "/texts/marks/" }
+      ]
+
+    .. rubric:: Response
+
+    ::
+
+      HTTP/1.1 200 OK
+
+      {
+        "responses": [
+          {
+            "status": 200,
+            "headers": { "Content-Type": "application/json", ... },
+            "body": { "person": { "pers_no": 14506, ... }, ... }
+          },
+          ...
+        ]
+      }
+
+    .. rubric:: Example
+
+    ::
+
+      curl -v -X POST -H "Content-Type: application/json" \\
+           -H "Httpkom-Connection: 033556ee-3e52-423f-9c9a-d85aed7688a1" \\
+           -d '[ { "path": "/sessions/current/who-am-i" }, { "path": "/texts/marks/" } ]' \\
+           "http://localhost:5001/lyskom/batch"
+
+    """
+    sub_requests = request.json
+    if not isinstance(sub_requests, list):
+        return error_response(400, error_msg='Expected a list of sub-requests.')
+    if len(sub_requests) > _MAX_SUB_REQUESTS:
+        return error_response(400, error_msg='Too many sub-requests (max {}).'.format(
+                _MAX_SUB_REQUESTS))
+    try:
+        parsed = [ _parse_sub_request(sub) for sub in sub_requests ]
+    except ValueError as ex:
+        return error_response(400, error_msg=str(ex))
+
+    connection_id = request.headers.get(HTTPKOM_CONNECTION_HEADER, None)
+    # Group consecutive GET/HEAD sub-requests, so they can run at the
+    # same time.
+    groups = []
+    for call in parsed:
+        method = call[0]
+        if method in ('GET', 'HEAD') and groups and groups[-1][0] in ('GET', 'HEAD'):
+            groups[-1][1].append(call)
+        else:
+            groups.append((method, [ call ]))
+
+    responses = []
+    for method, calls in groups:
+        results = _dispatch_concurrently(g.server.id, connection_id, calls)
+        for result in results:
+            connection_id = result['headers'].get(HTTPKOM_CONNECTION_HEADER, connection_id)
+        responses.extend(results)
+    return jsonify(responses=responses)
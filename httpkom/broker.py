@@ -0,0 +1,233 @@
+# -*- coding: utf-8 -*-
+# Copyright (C) 2012 Oskar Skoog. Released under GPL.
+
+"""LysKOM socket broker.
+
+The broker is a long-lived process that owns the LysKOM connections
+(the KomSession objects). The HTTP processes talk to it over a local
+Unix socket, which makes it possible to run several HTTP worker
+processes and to restart them without dropping the users' LysKOM
+sessions.
+
+Start the broker::
+
+  python -m httpkom.broker --socket /var/run/httpkom/broker.sock
+
+and point the HTTP processes to it in the configuration::
+
+  HTTPKOM_BROKER_SOCKET = '/var/run/httpkom/broker.sock'
+
+The HTTP processes can then for example be run with several gunicorn
+workers.
+
+IPC protocol
+------------
+
+Each message is a 4 byte big-endian length followed by a pickled
+tuple. A request is::
+
+  (op, connection_id, args, kwargs)
+
+where op is one of:
+
+=======  ====================================================================
+op       Meaning
+=======  ====================================================================
+open     Connect a new KomSession, stored as connection_id. args and kwargs
+         are passed to KomSession.connect().
+call     Call a KomSession method. args[0] is the method name, the rest of
+         args and kwargs are passed to the method.
+exists   Returns True if there is a KomSession for connection_id.
+close    Forget the KomSession for connection_id.
+=======  ====================================================================
+
+The response is ``(True, value)`` or ``(False, exception)``. Exceptions
+raised by the KomSession (for example pylyskom errors) are re-raised
+in the HTTP process. Since pickle is used, the socket must only be
+accessible by the httpkom processes.
+"""
+
+from __future__ import absolute_import
+import argparse
+import logging
+import os
+import pickle
+import socket
+import struct
+import threading
+
+import six
+from six.moves import socketserver
+
+from pylyskom.komsession import KomSessionNotConnected
+
+from .pipelining import new_komsession
+
+
+log = logging.getLogger("httpkom.broker")
+
+_header = struct.Struct('>I')
+
+
+class BrokerError(Exception):
+    pass
+
+
+def _send_message(sock, obj):
+    data = pickle.dumps(obj, pickle.HIGHEST_PROTOCOL)
+    sock.sendall(_header.pack(len(data)) + data)
+
+def _recv_exactly(sock, size):
+    chunks = []
+    while size > 0:
+        chunk = sock.recv(min(size, 65536))
+        if not chunk:
+            raise EOFError("Broker connection closed")
+        chunks.append(chunk)
+        size -= len(chunk)
+    return b''.join(chunks)
+
+def _recv_message(sock):
+    size, = _header.unpack(_recv_exactly(sock, _header.size))
+    return pickle.loads(_recv_exactly(sock, size))
+
+
+class _BrokerRequestHandler(socketserver.BaseRequestHandler):
+    def handle(self):
+        while True:
+            try:
+                op, connection_id, args, kwargs = _recv_message(self.request)
+            except EOFError:
+                return
+            try:
+                response = (True, self.server.broker.dispatch(op, connection_id, args, kwargs))
+            except Exception as ex:
+                response = (False, ex)
+            try:
+                _send_message(self.request, response)
+            except (pickle.PicklingError, TypeError, AttributeError) as ex:
+                _send_message(self.request, (False, BrokerError(
+                    "Could not send response: %r (%s)" % (response[1], ex))))
+
+
+class _BrokerServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+
+class KomSessionBroker(object):
+    """Owns the KomSessions and serves them over a Unix socket."""
+    def __init__(self, path, session_factory=new_komsession):
+        self._path = path
+        self._session_factory = session_factory
+        self._sessions = {}
+        self._sessions_lock = threading.Lock()
+        self._server = None
+
+    def dispatch(self, op, connection_id, args, kwargs):
+        if op == 'open':
+            ksession = self._session_factory()
+            ksession.connect(*args, **kwargs)
+            with self._sessions_lock:
+                self._sessions[connection_id] = (ksession, threading.RLock())
+            return None
+        elif op == 'call':
+            with self._sessions_lock:
+                if connection_id not in self._sessions:
+                    raise KomSessionNotConnected()
+                ksession, lock = self._sessions[connection_id]
+            method = getattr(ksession, args[0])
+            with lock:
+                return method(*args[1:], **kwargs)
+        elif op == 'exists':
+            with self._sessions_lock:
+                return connection_id in self._sessions
+        elif op == 'close':
+            with self._sessions_lock:
+                self._sessions.pop(connection_id, None)
+            return None
+        else:
+            raise BrokerError("Unknown op: %s" % op)
+
+    def serve_forever(self):
+        if os.path.exists(self._path):
+            os.unlink(self._path)
+        self._server = _BrokerServer(self._path, _BrokerRequestHandler)
+        self._server.broker = self
+        os.chmod(self._path, 0o600)
+        log.info("Broker listening on %s", self._path)
+        self._server.serve_forever()
+
+    def shutdown(self):
+        if self._server is not None:
+            self._server.shutdown()
+            self._server.server_close()
+
+
+class BrokerClient(object):
+    """Client side of the broker IPC. Each thread uses its own socket
+    to the broker, so calls from different threads don't interleave.
+    """
+    def __init__(self, path):
+        self._path = path
+        self._local = threading.local()
+
+    def _socket(self):
+        sock = getattr(self._local, 'sock', None)
+        if sock is None:
+            sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            sock.connect(self._path)
+            self._local.sock = sock
+        return sock
+
+    def request(self, op, connection_id, *args, **kwargs):
+        try:
+            sock = self._socket()
+            _send_message(sock, (op, connection_id, args, kwargs))
+            ok, value = _recv_message(sock)
+        except (EOFError, socket.error) as ex:
+            self._local.sock = None
+            raise BrokerError("Broker request failed: %s" % ex)
+        if not ok:
+            six.reraise(type(value), value)
+        return value
+
+
+class RemoteKomSession(object):
+    """Proxy for a KomSession owned by the broker. Method calls are
+    forwarded to the broker.
+    """
+    def __init__(self, client, connection_id):
+        self._client = client
+        self.connection_id = connection_id
+
+    def connect(self, *args, **kwargs):
+        self._client.request('open', self.connection_id, *args, **kwargs)
+
+    def exists(self):
+        return self._client.request('exists', self.connection_id)
+
+    def release(self):
+        self._client.request('close', self.connection_id)
+
+    def __getattr__(self, name):
+        if name.startswith('_'):
+            raise AttributeError(name)
+        def remote_call(*args, **kwargs):
+            return self._client.request('call', self.connection_id, name, *args, **kwargs)
+        remote_call.__name__ = name
+        return remote_call
+
+
+def main():
+    logging.basicConfig(format='%(asctime)s %(levelname)s %(message)s', level=logging.INFO)
+
+    parser = argparse.ArgumentParser(description='LysKOM socket broker for httpkom.')
+    parser.add_argument('--socket', help='Path to the Unix socket to listen on',
+                        required=True)
+    args = parser.parse_args()
+
+    KomSessionBroker(os.path.abspath(args.socket)).serve_forever()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,129 @@
+# -*- coding: utf-8 -*-
+# Copyright (C) 2012 Oskar Skoog. Released under GPL.
+
+"""Compression of responses.
+
+Responses are compressed with brotli (if the brotli module is
+installed) or gzip, depending on the request's Accept-Encoding, if
+their content type is in HTTPKOM_COMPRESSION_MIMETYPES (so already
+compressed bodies, like images, are sent as they are). Responses with
+a known length are only compressed if they are at least
+HTTPKOM_COMPRESSION_MIN_SIZE bytes. Streamed responses are compressed
+a chunk at a time, and each chunk is flushed so that it can be
+decompressed by the client as soon as it arrives.
+"""
+
+from __future__ import absolute_import
+import zlib
+
+from flask import request
+
+from httpkom import app
+from .stats import stats
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+
+def _gzip_compressor():
+    # wbits 16 + MAX_WBITS gives a gzip header and trailer.
+    compressor = zlib.compressobj(app.config['HTTPKOM_COMPRESSION_LEVEL'], zlib.DEFLATED,
+                                  16 + zlib.MAX_WBITS)
+    return (compressor.compress,
+            lambda: compressor.flush(zlib.Z_SYNC_FLUSH),
+            compressor.flush)
+
+def _brotli_compressor():
+    compressor = brotli.Compressor(quality=app.config['HTTPKOM_BROTLI_QUALITY'])
+    # The Brotli bindings call it process(), brotlipy calls it compress().
+    if hasattr(compressor, 'process'):
+        compress = compressor.process
+    else:
+        compress = compressor.compress
+    return compress, compressor.flush, compressor.finish
+
+# Content-Encoding -> function that returns (compress, flush, finish)
+_compressors = { 'gzip': _gzip_compressor }
+if brotli is not None:
+    _compressors['br'] = _brotli_compressor
+
+# In order of preference, when the client accepts several.
+_encodings = [ e for e in ('br', 'gzip') if e in _compressors ]
+
+
+def _is_compressible(mimetype):
+    if not mimetype:
+        # Empty responses have no Content-Type.
+        return False
+    for allowed in app.config['HTTPKOM_COMPRESSION_MIMETYPES']:
+        if allowed.endswith('/*'):
+            if mimetype.startswith(allowed[:-1]):
+                return True
+        elif mimetype == allowed:
+            return True
+    return False
+
+def _weaken_etag(response):
+    # The compressed body is not byte for byte the same as the
+    # uncompressed one.
+    etag, weak = response.get_etag()
+    if etag is not None and not weak:
+        response.set_etag(etag, weak=True)
+
+def _compress(data, encoding):
+    compress, flush, finish = _compressors[encoding]()
+    return compress(data) + finish()
+
+def _compress_stream(chunks, encoding):
+    compress, flush, finish = _compressors[encoding]()
+    try:
+        for chunk in chunks:
+            if chunk:
+                yield compress(chunk) + flush()
+        yield finish()
+    finally:
+        if hasattr(chunks, 'close'):
+            chunks.close()
+
+
+@app.after_request
+def compress_response(response):
+    if not app.config['HTTPKOM_COMPRESSION']:
+        return response
+    if response.status_code == 304:
+        # A 304 has no body, but its ETag must match the one the
+        # (compressed) 200 response had.
+        if request.accept_encodings.best_match(_encodings) is not None:
+            response.vary.add('Accept-Encoding')
+            _weaken_etag(response)
+        return response
+    if (request.method == 'HEAD' or response.status_code in (204, 206) or
+        'Content-Encoding' in response.headers or not _is_compressible(response.mimetype)):
+        return response
+
+    # The response depends on Accept-Encoding even when it is not
+    # compressed for this request.
+    response.vary.add('Accept-Encoding')
+    size = response.content_length
+    if size is not None and size < app.config['HTTPKOM_COMPRESSION_MIN_SIZE']:
+        return response
+    encoding = request.accept_encodings.best_match(_encodings)
+    if encoding is None:
+        return response
+
+    if response.is_streamed or response.direct_passthrough:
+        response.direct_passthrough = False
+        response.response = _compress_stream(response.response, encoding)
+        del response.headers['Content-Length']
+    else:
+        data = response.get_data()
+        if len(data) < app.config['HTTPKOM_COMPRESSION_MIN_SIZE']:
+            return response
+        response.set_data(_compress(data, encoding))
+    response.headers['Content-Encoding'] = encoding
+
+    _weaken_etag(response)
+    stats.set('http.responses.compressed.{}.last'.format(encoding), 1, agg='sum')
+    return response
@@ -2,23 +2,37 @@
 # Copyright (C) 2012 Oskar Skoog. Released under GPL.
 
 from __future__ import absolute_import
-from flask import g, request, jsonify
+from flask import g, request
 
 import pylyskom.errors as komerror
+from pylyskom.komsession import KomText
 
-from .komserialization import to_dict
+from .komserialization import LOOKUPS_NONE, to_dict, to_dict_chunks
 
 from httpkom import bp
 from .errors import error_response
-from .misc import empty_response, get_bool_arg_with_default
-from .sessions import requires_session, requires_login
+from .jsonresponse import jsonify, stream_jsonify
+from .misc import (empty_response, get_bool_arg_with_default, get_serialization_args,
+                   make_etag, is_not_modified, not_modified_response)
+from .nameindex import get_name_index
+from .pipelining import prefetch
+from .sessions import allows_shared_session, requires_login, stream_with_komsession
+from . import textmaps
+from .unreads import invalidate_unreads
 
 
 @bp.route('/conferences/')
-@requires_session
+@allows_shared_session
 def conferences_list():
     """Lookup conference names.
     
+    Does not require a Httpkom-Connection. Without one, the lookup is
+    done using a shared, not logged in, session.
+    
+    If HTTPKOM_NAME_INDEX is set, the lookup is done in httpkom's own
+    index of the server's names instead of asking the LysKOM server
+    (secret conferences are then never included).
+    
     Query parameters:
     
     ==========  =======  =================================================================
@@ -69,7 +83,13 @@ def conferences_list():
     want_confs = get_bool_arg_with_default(request.args, 'want-confs', True)
         
     try:
-        lookup = g.ksession.lookup_name(name, want_pers, want_confs)
+        name_index = get_name_index(g.server)
+        # "#<conf_no>" is resolved by the LysKOM session, and the index
+        # doesn't know about it.
+        if name_index is not None and not name.startswith('#'):
+            lookup = name_index.lookup(name, want_pers, want_confs)
+        else:
+            lookup = g.ksession.lookup_name(name, want_pers, want_confs)
         confs = [ dict(conf_no=t[0], conf_name=t[1]) for t in lookup ]
         return jsonify(dict(conferences=confs))
     except komerror.Error as ex:
@@ -88,6 +108,9 @@ def conferences_get(conf_no):
     =======  =======  =================================================================
     micro    boolean  :true: (Default) Return micro conference information (`UConference <http://www.lysator.liu.se/lyskom/protocol/11.1/protocol-a.html#Conferences>`_) which causes less load on the server.
                       :false: Return full conference information.
+    fields   string   Comma separated list of fields to include (see :doc:`intro`).
+                      Default: all
+    lookups  string   ``none``, ``names`` or ``full`` (see :doc:`intro`). Default: ``full``
     =======  =======  =================================================================
     
     .. rubric:: Request
@@ -170,6 +193,9 @@ def conferences_get(conf_no):
       
       { TODO: error stuff }
     
+    The response has a (weak) ETag, and a request with a matching
+    If-None-Match gets the response ``304 Not Modified``.
+    
     .. rubric:: Example
     
     ::
@@ -179,8 +205,16 @@ def conferences_get(conf_no):
     """
     try:
         micro = get_bool_arg_with_default(request.args, 'micro', True)
-        return jsonify(to_dict(g.ksession.get_conference(conf_no, micro),
-                               True, g.ksession))
+        lookups, fields = get_serialization_args(request.args)
+        conf = g.ksession.get_conference(conf_no, micro)
+        # Without lookups, the serialization doesn't need the server.
+        etag = make_etag(micro, sorted(to_dict(conf, False).items()))
+        if is_not_modified(etag):
+            return not_modified_response(etag, weak=True)
+        
+        response = jsonify(to_dict(conf, lookups, g.ksession, fields))
+        response.set_etag(etag, weak=True)
+        return response
     except komerror.UndefinedConference as ex:
         return error_response(404, kom_error=ex)
 
@@ -211,16 +245,18 @@ def conferences_put_text_read_marking(conf_no, local_text_no):
     """
     # TODO: handle conferences/texts that doesn't exist (i.e. return 404).
     g.ksession.mark_as_read_local(local_text_no, conf_no)
+    invalidate_unreads(g.ksession, conf_no)
     return empty_response(201)
 
 
 @bp.route('/conferences/<int:conf_no>/texts/')
-@requires_session
+@allows_shared_session
 def conferences_get_texts(conf_no):
     """Get the last created texts in the conference. Returns all text
     stats, but not the subject or body.
     
-    TODO: Query parameters for pagination.
+    Does not require a Httpkom-Connection. Without one, only texts
+    that can be read without logging in are returned.
     
     Query parameters:
     
@@ -228,8 +264,26 @@ def conferences_get_texts(conf_no):
     Key          Type     Values
     ===========  =======  =================================================================
     no-of-texts  integer  Number of text numbers to return. Default: 10
+    before       integer  Return the texts before this local text number, newest first.
+    after        integer  Return the texts after this local text number, oldest first.
+    fields       string   Comma separated list of fields to include in each text (see
+                          :doc:`intro`). Default: all
+    lookups      string   ``none``, ``names`` or ``full`` (see :doc:`intro`).
+                          Default: ``full``
     ===========  =======  =================================================================
     
+    Without before and after, the last texts are returned (oldest
+    first). To page through the conference, use the local number of
+    the oldest text in the response as before (or the newest as
+    after) in the next request. "has_more" tells if there are more
+    texts in that direction (older texts, without before and after).
+    Pagination is not supported together with HTTPKOM_BROKER_SOCKET.
+    
+    The list is streamed: it is serialized and sent a part at a time.
+    With ``Accept: application/x-ndjson``, the texts are sent as
+    NDJSON (one per line), and has_more in the Httpkom-Has-More header
+    (see :doc:`intro`).
+    
     .. rubric:: Request
     
     ::
@@ -265,7 +319,8 @@ def conferences_get_texts(conf_no):
           },
           
           ...
-        ]
+        ],
+        "has_more": true
       }
     
     .. rubric:: Example
@@ -274,8 +329,42 @@ def conferences_get_texts(conf_no):
     
       curl -v -X GET -H "Content-Type: application/json" \\
            "http://localhost:5001/lyskom/conferences/texts/?no-of-texts=3"
+      
+      curl -v -X GET -H "Content-Type: application/json" \\
+           "http://localhost:5001/lyskom/conferences/14506/texts/?no-of-texts=3&before=27"
     
     """
-    no_of_texts = int(request.args.get('no-of-texts', 10))
-    texts = g.ksession.get_last_texts(conf_no, no_of_texts)
-    return jsonify(texts=to_dict(texts, True, g.ksession))
+    try:
+        no_of_texts = int(request.args.get('no-of-texts', 10))
+        before = request.args.get('before', None, type=int)
+        after = request.args.get('after', None, type=int)
+    except ValueError:
+        return error_response(400, error_msg='Invalid "no-of-texts".')
+    if before is not None and after is not None:
+        return error_response(400, error_msg='Both "before" and "after" given.')
+    lookups, fields = get_serialization_args(request.args)
+    
+    if not textmaps.is_supported(g.ksession):
+        if before is not None or after is not None:
+            return error_response(400, error_msg='Pagination is not supported.')
+        texts = g.ksession.get_last_texts(conf_no, no_of_texts)
+        chunks = to_dict_chunks(texts, lookups, g.ksession, fields)
+        return stream_jsonify('texts', stream_with_komsession(chunks))
+    
+    try:
+        page, has_more = textmaps.get_page(g.ksession, conf_no, no_of_texts, before, after)
+    except komerror.UndefinedConference as ex:
+        return error_response(404, kom_error=ex)
+    # The author names are only needed if they are looked up.
+    author_names = lookups != LOOKUPS_NONE and (fields is None or 'author' in fields)
+    prefetch(g.ksession, text_nos=[ text_no for local_no, text_no in page ],
+             author_conf_nos=author_names)
+    texts = []
+    for local_no, text_no in page:
+        try:
+            texts.append(KomText(text_no=text_no, text=None,
+                                 text_stat=g.ksession.get_text_stat(text_no)))
+        except (komerror.NoSuchText, komerror.TextZero):
+            textmaps.forget_text(g.ksession, conf_no, local_no)
+    chunks = to_dict_chunks(texts, lookups, g.ksession, fields)
+    return stream_jsonify('texts', stream_with_komsession(chunks), has_more=has_more)
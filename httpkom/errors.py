@@ -2,12 +2,11 @@
 # Copyright (C) 2012 Oskar Skoog. Released under GPL.
 
 from __future__ import absolute_import
-from flask import jsonify
-
 from pylyskom.errors import error_dict, ServerError, LoginFirst, LocalError
 from pylyskom.komsession import KomSessionError
 
 from httpkom import app
+from .jsonresponse import jsonify
 from .misc import empty_response
 from .stats import stats
 
@@ -22,16 +21,20 @@ def _kom_servererror_to_error_code(ex):
     else:
         return None
 
+def kom_error_to_dict(kom_error):
+    """The error object of error_response, for a pylyskom error."""
+    # The error should exist in the dictionary, but we use .get() to be safe
+    return dict(error_code=_kom_servererror_to_error_code(kom_error),
+                error_status=str(kom_error),
+                error_type="protocol-a",
+                error_msg=str(kom_error.__class__.__name__))
+
 def error_response(status_code, kom_error=None, error_msg=""):
     # TODO: I think we need to unify these error types to make the API
     # easier. Perhaps use protocol a error codes as they are, and
     # add our own httpkom error codes on 1000 and above?
     if kom_error is not None:
-        # The error should exist in the dictionary, but we use .get() to be safe
-        response = jsonify(error_code=_kom_servererror_to_error_code(kom_error),
-                           error_status=str(kom_error),
-                           error_type="protocol-a",
-                           error_msg=str(kom_error.__class__.__name__))
+        response = jsonify(kom_error_to_dict(kom_error))
     else:
         # We don't have any fancy error codes for httpkom yet.
         response = jsonify(error_type="httpkom",
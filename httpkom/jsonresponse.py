@@ -0,0 +1,129 @@
+# -*- coding: utf-8 -*-
+# Copyright (C) 2012 Oskar Skoog. Released under GPL.
+
+"""JSON responses.
+
+Replaces flask.jsonify, which uses the json module from the standard
+library and (in Flask 0.12) indents the output unless the request is
+an XHR request. Responses here are always compact, and are encoded
+with the fastest JSON library that is installed: orjson, rapidjson or
+ujson, in that order, or the json module. HTTPKOM_JSON_BACKEND can
+name one of them. Only the json module sorts the keys (if
+JSON_SORT_KEYS is set, as in flask.jsonify).
+
+Long lists can be streamed with stream_jsonify, as JSON or (if the
+client asks for it) NDJSON.
+"""
+
+from __future__ import absolute_import
+import json
+
+import six
+from flask import request
+
+from httpkom import app
+
+
+# On Python 2, json.dumps with ensure_ascii=False returns str or
+# unicode depending on the strings in the object, and fails if it has
+# both non-ASCII str and unicode. ASCII output is the same bytes either
+# way.
+_ensure_ascii = six.PY2
+
+
+def _orjson_dumps():
+    import orjson
+    option = orjson.OPT_NON_STR_KEYS
+    return lambda obj: orjson.dumps(obj, option=option)
+
+def _rapidjson_dumps():
+    import rapidjson
+    return lambda obj: rapidjson.dumps(obj, ensure_ascii=_ensure_ascii).encode('utf-8')
+
+def _ujson_dumps():
+    import ujson
+    return lambda obj: ujson.dumps(obj, ensure_ascii=_ensure_ascii).encode('utf-8')
+
+def _json_dumps():
+    return lambda obj: json.dumps(obj, ensure_ascii=_ensure_ascii, separators=(',', ':'),
+                                  sort_keys=app.config['JSON_SORT_KEYS']).encode('utf-8')
+
+_backends = [ ('orjson', _orjson_dumps), ('rapidjson', _rapidjson_dumps),
+              ('ujson', _ujson_dumps), ('json', _json_dumps) ]
+
+
+def _select_backend(name):
+    for backend_name, make_dumps in _backends:
+        if name is None or name == backend_name:
+            try:
+                return backend_name, make_dumps()
+            except ImportError:
+                if name is not None:
+                    app.logger.warning("JSON backend %s is not installed", name)
+    return 'json', _json_dumps()
+
+backend, _dumps = _select_backend(app.config['HTTPKOM_JSON_BACKEND'])
+
+
+def dumps(obj):
+    """Encode obj as compact JSON (UTF-8 bytes)."""
+    try:
+        return _dumps(obj)
+    except (TypeError, OverflowError):
+        # Types that only Flask's encoder knows about (dates, UUIDs).
+        return json.dumps(obj, cls=app.json_encoder, ensure_ascii=_ensure_ascii,
+                          separators=(',', ':'),
+                          sort_keys=app.config['JSON_SORT_KEYS']).encode('utf-8')
+
+
+def jsonify(*args, **kwargs):
+    """Same as flask.jsonify, but compact and faster."""
+    if args and kwargs:
+        raise TypeError('jsonify() behavior undefined when passed both args and kwargs')
+    elif len(args) == 1:
+        data = args[0]
+    else:
+        data = args or kwargs
+    return app.response_class(dumps(data), mimetype='application/json')
+
+
+NDJSON_MIMETYPE = 'application/x-ndjson'
+
+def wants_ndjson():
+    """Check if the request's Accept header prefers NDJSON (one JSON
+    value per line) to JSON.
+    """
+    best = request.accept_mimetypes.best_match(['application/json', NDJSON_MIMETYPE])
+    return best == NDJSON_MIMETYPE
+
+
+def stream_jsonify(key, chunks, **kwargs):
+    """Same as jsonify(**kwargs), with a list under key that is
+    encoded and sent one chunk (a list of elements) at a time, as
+    chunks produces them.
+    
+    If the client wants NDJSON (see wants_ndjson), each element is
+    sent as a line of its own, and kwargs are sent as headers
+    instead: has_more becomes Httpkom-Has-More, with the value JSON
+    encoded.
+    """
+    if wants_ndjson():
+        headers = dict(('Httpkom-' + k.replace('_', '-').title(), dumps(v).decode('utf-8'))
+                       for k, v in kwargs.items())
+        def generate_ndjson():
+            for chunk in chunks:
+                if chunk:
+                    yield b''.join(dumps(el) + b'\n' for el in chunk)
+        return app.response_class(generate_ndjson(), mimetype=NDJSON_MIMETYPE,
+                                  headers=headers)
+
+    def generate():
+        head = dumps(kwargs)[:-1] + b',' if kwargs else b'{'
+        yield head + dumps(key) + b':['
+        separator = b''
+        for chunk in chunks:
+            if chunk:
+                yield separator + b','.join(dumps(el) for el in chunk)
+                separator = b','
+        yield b']}'
+    return app.response_class(generate(), mimetype='application/json')
@@ -2,13 +2,17 @@
 # Copyright (C) 2012 Oskar Skoog. Released under GPL.
 
 from __future__ import absolute_import
+import operator
+
 from pylyskom import komauxitems, datatypes, errors
 from pylyskom.utils import decode_text, parse_content_type
 from pylyskom.komsession import (KomPerson, KomText, KomConference, KomUConference,
                                  KomMembership, KomMembershipUnread)
 
+from .pipelining import prefetch
+
 
-_ALLOWED_KOMTEXT_AUXITEMS = [
+_ALLOWED_KOMTEXT_AUXITEMS = frozenset([
     komauxitems.AI_FAST_REPLY,
     komauxitems.AI_MX_DATE,
     komauxitems.AI_MX_AUTHOR,
@@ -19,7 +23,7 @@ _ALLOWED_KOMTEXT_AUXITEMS = [
     komauxitems.AI_KOMFEEDER_TITLE,
     komauxitems.AI_KOMFEEDER_AUTHOR,
     komauxitems.AI_KOMFEEDER_DATE,
-]
+])
 
 
 MIRecipient_type_to_str = { datatypes.MIR_TO: 'to',
@@ -44,42 +48,180 @@ MICommentIn_str_to_type = { 'comment': datatypes.MIC_COMMENT,
 
 
 
-def to_dict(obj, lookups=False, session=None):
-    if obj is None:
-        return None
-    elif isinstance(obj, list) or isinstance(obj, tuple):
-        return [ to_dict(el, lookups, session) for el in obj ]
-    elif isinstance(obj, KomPerson):
-        return KomPerson_to_dict(obj, lookups, session)
-    elif isinstance(obj, KomText):
-        return KomText_to_dict(obj, lookups, session)
-    elif isinstance(obj, datatypes.MIRecipient):
-        return MIRecipient_to_dict(obj, lookups, session)
-    elif isinstance(obj, datatypes.MICommentTo):
-        return MICommentTo_to_dict(obj, lookups, session)
-    elif isinstance(obj, datatypes.MICommentIn):
-        return MICommentIn_to_dict(obj, lookups, session)
-    elif isinstance(obj, KomConference):
-        return KomConference_to_dict(obj, lookups, session)
-    elif isinstance(obj, KomUConference):
-        return KomUConference_to_dict(obj, lookups, session)
-    elif isinstance(obj, datatypes.ConfType):
-        return ConfType_to_dict(obj, lookups, session)
-    elif isinstance(obj, KomMembership):
-        return KomMembership_to_dict(obj, lookups, session)
-    elif isinstance(obj, KomMembershipUnread):
-        return KomMembershipUnread_to_dict(obj, lookups, session)
-    elif isinstance(obj, datatypes.MembershipType):
-        return MembershipType_to_dict(obj, lookups, session)
-    elif isinstance(obj, datatypes.AuxItem):
-        return AuxItem_to_dict(obj, lookups, session)
-    elif isinstance(obj, datatypes.Mark):
-        return Mark_to_dict(obj, lookups, session)
-    elif isinstance(obj, datatypes.Time):
-        return Time_to_dict(obj, lookups, session)
-    else:
-        #raise NotImplementedError("to_dict is not implemented for: %s" % type(obj))
+# Lookup levels for to_dict.
+LOOKUPS_NONE = 'none'
+LOOKUPS_NAMES = 'names'
+LOOKUPS_FULL = 'full'
+LOOKUP_LEVELS = (LOOKUPS_NONE, LOOKUPS_NAMES, LOOKUPS_FULL)
+
+
+def to_dict(obj, lookups=False, session=None, fields=None):
+    """Serialize obj (a pylyskom object, or a list of them) to
+    something that can be converted to JSON.
+    
+    lookups is one of LOOKUP_LEVELS (True means LOOKUPS_FULL and False
+    LOOKUPS_NONE). With LOOKUPS_NAMES, names of persons and
+    conferences are looked up using session. LOOKUPS_FULL also looks
+    up the authors of commented/comment texts. All the needed lookups
+    are first collected from the object graph and fetched in one
+    pipelined batch, before the dicts are built.
+    
+    If fields is given (a set of field names), only those fields of
+    obj (or of each object in obj, if it is a list) are included, and
+    nothing is looked up for the other fields.
+    """
+    lookups = _lookup_level(lookups)
+    if lookups and session is not None:
+        conf_nos = set()
+        text_nos = set()
+        _collect_lookups(obj, conf_nos, text_nos, fields)
+        if lookups != LOOKUPS_FULL:
+            text_nos = ()
+        prefetch(session, conf_nos, text_nos)
+    return _to_dict(obj, lookups, session, fields)
+
+def to_dict_chunks(objs, lookups=False, session=None, fields=None, chunk_size=100):
+    """Serialize the list objs like to_dict, but chunk_size objects at
+    a time. Yields a list of dicts per chunk. The lookups for each
+    chunk are fetched in one batch.
+    """
+    for i in range(0, len(objs), chunk_size):
+        yield to_dict(objs[i:i + chunk_size], lookups, session, fields)
+
+def _lookup_level(lookups):
+    """Internally, no lookups is False (so "if lookups" means that
+    names are looked up).
+    """
+    if lookups is True:
+        return LOOKUPS_FULL
+    if not lookups or lookups == LOOKUPS_NONE:
+        return False
+    if lookups not in LOOKUP_LEVELS:
+        raise ValueError("Unknown lookup level: %r" % (lookups,))
+    return lookups
+
+def _collect_lookups(obj, conf_nos, text_nos, fields=None):
+    """Collect the conference numbers (for name lookups) and text
+    numbers (for author lookups) that serializing obj (only fields,
+    if given) with lookups will need.
+    """
+    collector = _collectors.for_type(type(obj))
+    if collector is not None:
+        collector(obj, conf_nos, text_nos, fields)
+    conf_nos.discard(None)
+
+def _to_dict(obj, lookups, session, fields=None):
+    serializer = _serializers.for_type(type(obj))
+    if serializer is None:
         return obj
+    if fields is None:
+        return serializer(obj, lookups, session)
+    if serializer is _sequence_to_dict:
+        return _sequence_to_dict(obj, lookups, session, fields)
+    field_funcs = _field_serializers.for_type(type(obj))
+    if field_funcs is None:
+        d = serializer(obj, lookups, session)
+        if isinstance(d, dict):
+            d = dict((k, v) for k, v in d.items() if k in fields)
+        return d
+    d = {}
+    for name, func in field_funcs.items():
+        if name in fields:
+            value = func(obj, lookups, session)
+            if value is not _OMIT:
+                d[name] = value
+    return d
+
+
+class _TypeRegistry(object):
+    """Functions by type. A type gets the function of the first
+    registered type that it is a subclass of (like a chain of
+    isinstance checks in registration order), and the result is
+    cached per exact type.
+    """
+    def __init__(self):
+        self._registered = []
+        self._cache = {}
+
+    def register(self, cls, func):
+        self._registered.append((cls, func))
+        self._cache.clear()
+
+    def for_type(self, cls):
+        try:
+            return self._cache[cls]
+        except KeyError:
+            func = next((f for c, f in self._registered if issubclass(cls, c)), None)
+            self._cache[cls] = func
+            return func
+
+
+def register_serializer(cls, func, collector=None, field_funcs=None):
+    """Serialize objects of cls (and subclasses) with func(obj,
+    lookups, session). collector(obj, conf_nos, text_nos, fields) adds
+    the lookups that func will need (for the given fields, or all
+    fields if fields is None).
+    
+    When only some fields are selected, they are computed one by one
+    with field_funcs (field name -> func(obj, lookups, session)), if
+    given. Otherwise the other fields are removed from the dict that
+    func returns, so func should then not need any lookups.
+    """
+    _serializers.register(cls, func)
+    if collector is not None:
+        _collectors.register(cls, collector)
+    if field_funcs is not None:
+        _field_serializers.register(cls, field_funcs)
+
+
+def _fields(*names):
+    """Return a function that makes a dict of the given attributes of
+    an object.
+    """
+    getter = operator.attrgetter(*names)
+    if len(names) == 1:
+        return lambda obj: { names[0]: getter(obj) }
+    def fields_to_dict(obj):
+        return dict(zip(names, getter(obj)))
+    return fields_to_dict
+
+
+# Returned by a field function to leave the field out.
+_OMIT = object()
+
+def _field_funcs(plain, **computed):
+    """Field functions (name -> func(obj, lookups, session)) for
+    register_serializer: the plain attributes in plain, and computed.
+    They must give the same fields as the type's serializer.
+    """
+    funcs = dict((name, _attr_field(name)) for name in plain)
+    funcs.update(computed)
+    return funcs
+
+def _attr_field(name):
+    getter = operator.attrgetter(name)
+    return lambda obj, lookups, session: getter(obj)
+
+def _time_field(name):
+    getter = operator.attrgetter(name)
+    def time_field(obj, lookups, session):
+        time = getter(obj)
+        return None if time is None else Time_to_dict(time, lookups, session)
+    return time_field
+
+def _list_field(name):
+    getter = operator.attrgetter(name)
+    def list_field(obj, lookups, session):
+        seq = getter(obj)
+        return None if seq is None else [ _to_dict(el, lookups, session) for el in seq ]
+    return list_field
+
+def _aux_items_field(obj, lookups, session):
+    if obj.aux_items is None:
+        return None
+    return [ _to_dict(ai, lookups, session) for ai in obj.aux_items
+             if ai.tag in _ALLOWED_KOMTEXT_AUXITEMS ]
+
 
 def KomPerson_to_dict(kom_person, lookups, session):
     pers_name = None
@@ -96,38 +238,46 @@ def KomMembership_to_dict(membership, lookups, session):
         priority=membership.priority,
         added_by=pers_to_dict(membership.added_by, lookups, session),
         added_at=Time_to_dict(membership.added_at, lookups, session),
-        type=to_dict(membership.type, lookups, session))
+        type=_to_dict(membership.type, lookups, session))
+
+def _pers_name_field(kom_person, lookups, session):
+    if lookups:
+        return session.get_conf_name(kom_person.pers_no)
+    return None
+
+_KomPerson_fields = _field_funcs(['pers_no'], pers_name=_pers_name_field)
+
+_KomMembership_fields = _field_funcs(
+    ['pers_no', 'position', 'priority'],
+    last_time_read=_time_field('last_time_read'),
+    conference=lambda m, lookups, session: conf_to_dict(m.conference, lookups, session),
+    added_by=lambda m, lookups, session: pers_to_dict(m.added_by, lookups, session),
+    added_at=_time_field('added_at'),
+    type=lambda m, lookups, session: _to_dict(m.type, lookups, session))
 
 def KomMembershipUnread_to_dict(membership_unread, lookups, session):
     return dict(
         pers_no=membership_unread.pers_no,
         conf_no=membership_unread.conf_no,
         no_of_unread=membership_unread.no_of_unread,
-        unread_texts=to_dict(membership_unread.unread_texts, lookups, session))
+        unread_texts=_to_dict(membership_unread.unread_texts, lookups, session))
+
+_membership_type_fields = _fields('invitation', 'passive', 'secret', 'passive_message_invert')
 
 def MembershipType_to_dict(m_type, lookups, session):
-    return dict(
-        invitation=m_type.invitation,
-        passive=m_type.passive,
-        secret=m_type.secret,
-        passive_message_invert=m_type.passive_message_invert)
+    return _membership_type_fields(m_type)
+
+_conf_type_fields = _fields('rd_prot', 'original', 'secret', 'letterbox', 'allow_anonymous',
+                            'forbid_secret', 'reserved2', 'reserved3')
 
 def ConfType_to_dict(conf_type, lookups, session):
-    return dict(
-        rd_prot=conf_type.rd_prot,
-        original=conf_type.original,
-        secret=conf_type.secret,
-        letterbox=conf_type.letterbox,
-        allow_anonymous=conf_type.allow_anonymous,
-        forbid_secret=conf_type.forbid_secret,
-        reserved2=conf_type.reserved2,
-        reserved3=conf_type.reserved3)
+    return _conf_type_fields(conf_type)
 
 def KomConference_to_dict(conf, lookups, session):
     d = dict(
         conf_no=conf.conf_no,
         name=conf.name,
-        type=to_dict(conf.type, lookups, session),
+        type=_to_dict(conf.type, lookups, session),
         creation_time=Time_to_dict(conf.creation_time, lookups, session),
         last_written=Time_to_dict(conf.last_written, lookups, session),
         creator=pers_to_dict(conf.creator, lookups, session),
@@ -149,16 +299,29 @@ def KomConference_to_dict(conf, lookups, session):
     else:
         aux_items = []
         for ai in [ai for ai in conf.aux_items if ai.tag in _ALLOWED_KOMTEXT_AUXITEMS]:
-            aux_items.append(to_dict(ai, lookups, session))
+            aux_items.append(_to_dict(ai, lookups, session))
         d['aux_items'] = aux_items
 
     return d
 
+_KomConference_fields = _field_funcs(
+    ['conf_no', 'name', 'presentation', 'msg_of_day', 'nice', 'keep_commented',
+     'no_of_members', 'first_local_no', 'no_of_texts', 'expire'],
+    type=lambda conf, lookups, session: _to_dict(conf.type, lookups, session),
+    creation_time=_time_field('creation_time'),
+    last_written=_time_field('last_written'),
+    creator=lambda conf, lookups, session: pers_to_dict(conf.creator, lookups, session),
+    supervisor=lambda conf, lookups, session: conf_to_dict(conf.supervisor, lookups, session),
+    permitted_submitters=lambda conf, lookups, session: conf_to_dict(
+        conf.permitted_submitters, lookups, session),
+    super_conf=lambda conf, lookups, session: conf_to_dict(conf.super_conf, lookups, session),
+    aux_items=_aux_items_field)
+
 def KomUConference_to_dict(conf, lookups, session):
     return dict(
         conf_no=conf.conf_no,
         name=conf.name,
-        type=to_dict(conf.type, lookups, session),
+        type=_to_dict(conf.type, lookups, session),
         highest_local_no=conf.highest_local_no,
         nice=conf.nice
         )
@@ -181,19 +344,19 @@ def KomText_to_dict(komtext, lookups, session):
     if komtext.recipient_list is None:
         d['recipient_list'] = None
     else:
-        d['recipient_list'] = [ to_dict(r, lookups, session)
+        d['recipient_list'] = [ _to_dict(r, lookups, session)
                                 for r in komtext.recipient_list ]
     
     if komtext.comment_to_list is None:
         d['comment_to_list'] = None
     else:
-        d['comment_to_list'] = [ to_dict(ct, lookups, session)
+        d['comment_to_list'] = [ _to_dict(ct, lookups, session)
                                  for ct in komtext.comment_to_list ]
     
     if komtext.comment_in_list is None:
         d['comment_in_list'] = None
     else:
-        d['comment_in_list'] = [ to_dict(ci, lookups, session)
+        d['comment_in_list'] = [ _to_dict(ci, lookups, session)
                                  for ci in komtext.comment_in_list ]
     
     if komtext.aux_items is None:
@@ -201,7 +364,7 @@ def KomText_to_dict(komtext, lookups, session):
     else:
         aux_items = []
         for ai in [ai for ai in komtext.aux_items if ai.tag in _ALLOWED_KOMTEXT_AUXITEMS]:
-            aux_items.append(to_dict(ai, lookups, session))
+            aux_items.append(_to_dict(ai, lookups, session))
         d['aux_items'] = aux_items
     
     if komtext.creation_time is None:
@@ -211,6 +374,24 @@ def KomText_to_dict(komtext, lookups, session):
     
     return d
 
+def _body_field(komtext, lookups, session):
+    mime_type, encoding = parse_content_type(komtext.content_type)
+    if mime_type[0] == 'text':
+        return komtext.body
+    elif mime_type[0] == 'x-kom' and mime_type[1] == 'user-area':
+        return komtext.body
+    return _OMIT
+
+_KomText_fields = _field_funcs(
+    ['text_no', 'no_of_marks', 'content_type', 'subject'],
+    author=lambda komtext, lookups, session: pers_to_dict(komtext.author, lookups, session),
+    body=_body_field,
+    recipient_list=_list_field('recipient_list'),
+    comment_to_list=_list_field('comment_to_list'),
+    comment_in_list=_list_field('comment_in_list'),
+    aux_items=_aux_items_field,
+    creation_time=_time_field('creation_time'))
+
 def pers_to_dict(pers_no, lookups, session):
     if pers_no is None:
         return None
@@ -258,7 +439,7 @@ def MICommentTo_to_dict(micto, lookups, session):
         raise KeyError("Unknown MICommentTo type: %s" % micto.type)
     
     author = None
-    if lookups:
+    if lookups == LOOKUPS_FULL:
         try:
             cts = session.get_text_stat(micto.text_no)
             author = pers_to_dict(cts.author, lookups, session)
@@ -274,7 +455,7 @@ def MICommentIn_to_dict(micin, lookups, session):
         raise KeyError("Unknown MICommentIn type: %s" % micin.type)
     
     author = None
-    if lookups:
+    if lookups == LOOKUPS_FULL:
         try:
             cts = session.get_text_stat(micin.text_no)
             author = pers_to_dict(cts.author, lookups, session)
@@ -285,24 +466,96 @@ def MICommentIn_to_dict(micin, lookups, session):
                 text_no=micin.text_no,
                 author=author)
 
+_aux_item_flags_fields = _fields('deleted', 'inherit', 'secret', 'hide_creator', 'dont_garb')
+
 def AuxItem_to_dict(aux_item, lookups, session):
     return dict(aux_no=aux_item.aux_no,
                 tag=komauxitems.aux_item_number_to_name[aux_item.tag],
                 creator=pers_to_dict(aux_item.creator, lookups, session),
                 created_at=Time_to_dict(aux_item.created_at, lookups, session),
-                flags=dict(deleted=aux_item.flags.deleted,
-                           inherit=aux_item.flags.inherit,
-                           secret=aux_item.flags.secret,
-                           hide_creator=aux_item.flags.hide_creator,
-                           dont_garb=aux_item.flags.dont_garb),
+                flags=_aux_item_flags_fields(aux_item.flags),
                 inherit_limit=aux_item.inherit_limit,
                 
                 # aux-items are always latin-1 it seems like, but we
                 # can afford to try with utf-8 first anyway.
                 data=decode_text(aux_item.data, 'utf-8', backup_encoding='latin-1'))
 
+_mark_fields = _fields('text_no', 'type')
+
 def Mark_to_dict(mark, lookups, session):
-    return dict(text_no=mark.text_no, type=mark.type)
+    return _mark_fields(mark)
 
 def Time_to_dict(time, lookups, session):
     return time.to_iso_8601()
+
+
+def _sequence_to_dict(seq, lookups, session, fields=None):
+    return [ _to_dict(el, lookups, session, fields) for el in seq ]
+
+def _wanted(fields, name):
+    return fields is None or name in fields
+
+def _collect_sequence(seq, conf_nos, text_nos, fields):
+    for el in seq:
+        _collect_lookups(el, conf_nos, text_nos, fields)
+
+def _collect_KomPerson(kom_person, conf_nos, text_nos, fields):
+    if _wanted(fields, 'pers_name'):
+        conf_nos.add(kom_person.pers_no)
+
+def _collect_KomText(komtext, conf_nos, text_nos, fields):
+    if _wanted(fields, 'author'):
+        conf_nos.add(komtext.author)
+    for name in ('recipient_list', 'comment_to_list', 'comment_in_list', 'aux_items'):
+        if _wanted(fields, name):
+            _collect_lookups(getattr(komtext, name), conf_nos, text_nos)
+
+def _collect_MIRecipient(mir, conf_nos, text_nos, fields):
+    conf_nos.add(mir.recpt)
+    conf_nos.add(mir.sent_by)
+
+def _collect_MIComment(mic, conf_nos, text_nos, fields):
+    text_nos.add(mic.text_no)
+
+def _collect_KomConference(conf, conf_nos, text_nos, fields):
+    for name in ('creator', 'supervisor', 'permitted_submitters', 'super_conf'):
+        if _wanted(fields, name):
+            conf_nos.add(getattr(conf, name))
+    if _wanted(fields, 'aux_items'):
+        _collect_lookups(conf.aux_items, conf_nos, text_nos)
+
+def _collect_KomMembership(membership, conf_nos, text_nos, fields):
+    if _wanted(fields, 'conference'):
+        conf_nos.add(membership.conference)
+    if _wanted(fields, 'added_by'):
+        conf_nos.add(membership.added_by)
+
+def _collect_AuxItem(aux_item, conf_nos, text_nos, fields):
+    if aux_item.tag in _ALLOWED_KOMTEXT_AUXITEMS:
+        conf_nos.add(aux_item.creator)
+
+
+_serializers = _TypeRegistry()
+_collectors = _TypeRegistry()
+_field_serializers = _TypeRegistry()
+
+# In the order of the old isinstance chain, so subclasses are
+# serialized the same way.
+register_serializer(list, _sequence_to_dict, _collect_sequence)
+register_serializer(tuple, _sequence_to_dict, _collect_sequence)
+register_serializer(KomPerson, KomPerson_to_dict, _collect_KomPerson, _KomPerson_fields)
+register_serializer(KomText, KomText_to_dict, _collect_KomText, _KomText_fields)
+register_serializer(datatypes.MIRecipient, MIRecipient_to_dict, _collect_MIRecipient)
+register_serializer(datatypes.MICommentTo, MICommentTo_to_dict, _collect_MIComment)
+register_serializer(datatypes.MICommentIn, MICommentIn_to_dict, _collect_MIComment)
+register_serializer(KomConference, KomConference_to_dict, _collect_KomConference,
+                    _KomConference_fields)
+register_serializer(KomUConference, KomUConference_to_dict)
+register_serializer(datatypes.ConfType, ConfType_to_dict)
+register_serializer(KomMembership, KomMembership_to_dict, _collect_KomMembership,
+                    _KomMembership_fields)
+register_serializer(KomMembershipUnread, KomMembershipUnread_to_dict)
+register_serializer(datatypes.MembershipType, MembershipType_to_dict)
+register_serializer(datatypes.AuxItem, AuxItem_to_dict, _collect_AuxItem)
+register_serializer(datatypes.Mark, Mark_to_dict)
+register_serializer(datatypes.Time, Time_to_dict)
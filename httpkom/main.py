@@ -10,6 +10,7 @@ from pylyskom import stats
 from pylyskom.stats import stats as pylyskom_stats
 from httpkom.stats import stats as httpkom_stats
 from httpkom import app
+from httpkom.sessions import start_name_index_updaters, start_session_reaper
 
 
 log = logging.getLogger("httpkom.main")
@@ -40,8 +41,10 @@ def run_http_server(args):
         'log.screen': True,
         'server.socket_port': args.port,
         'server.socket_host': args.host,
-        'server.thread_pool': 1,
-        'server.thread_pool_max': 1,
+        # Requests for different sessions are served in parallel,
+        # requests for the same session are serialized by httpkom.
+        'server.thread_pool': args.threads,
+        'server.thread_pool_max': args.threads,
     })
     cherrypy.log.access_log.propagate = False
     cherrypy.log.error_log.propagate = False
@@ -51,6 +54,23 @@ def run_http_server(args):
     cherrypy.engine.block()
 
 
+def run_asgi_server(args):
+    os.environ['HTTPKOM_SETTINGS'] = args.config
+
+    try:
+        import uvicorn
+    except ImportError:
+        log.error("The asgi server requires uvicorn (pip install uvicorn)")
+        sys.exit(1)
+
+    from httpkom.asgi import AsgiApp
+
+    # Enable WSGI access logging via Paste, same as for CherryPy.
+    asgi_app = AsgiApp(TransLogger(app), max_workers=args.threads)
+    uvicorn.run(asgi_app, host=args.host, port=args.port,
+                access_log=False, lifespan='on')
+
+
 def main():
     logging.basicConfig(format='%(asctime)s %(levelname)s %(message)s', level=logging.INFO)
 
@@ -63,6 +83,11 @@ def main():
                         default='0.0.0.0')
     parser.add_argument('--port', help='Port to listen on',
                         type=int, default=5001)
+    parser.add_argument('--threads', help='Number of threads for serving requests',
+                        type=int, default=10)
+    parser.add_argument('--server', help='HTTP front end to use: cherrypy, or asgi (uvicorn '
+                        'running the same WSGI app in --threads worker threads)',
+                        choices=['cherrypy', 'asgi'], default='cherrypy')
 
     parser.add_argument('--graphite-host', help='Hostname or IP to Graphite server to send stats to',
                         default=None)
@@ -79,7 +104,12 @@ def main():
         sys.exit(1)
 
     start_stats_sender(args.graphite_host, args.graphite_port)
-    run_http_server(args)
+    start_session_reaper()
+    start_name_index_updaters()
+    if args.server == 'asgi':
+        run_asgi_server(args)
+    else:
+        run_http_server(args)
 
 
 if __name__ == "__main__":
@@ -2,16 +2,19 @@
 # Copyright (C) 2012 Oskar Skoog. Released under GPL.
 
 from __future__ import absolute_import
-from flask import g, request, jsonify
+from flask import g, request
 
 import pylyskom.errors as komerror
 
-from .komserialization import to_dict
+from .komserialization import to_dict, to_dict_chunks
 
 from httpkom import bp
 from .errors import error_response
-from .misc import empty_response, get_bool_arg_with_default
-from .sessions import requires_login
+from .jsonresponse import jsonify, stream_jsonify
+from .misc import empty_response, get_bool_arg_with_default, get_serialization_args
+from .reader import get_next_unread_texts
+from .sessions import requires_login, stream_with_komsession
+from .unreads import get_unread_tracker, invalidate_unreads
 
 
 @bp.route('/persons/<int:pers_no>/memberships/<int:conf_no>', methods=['PUT'])
@@ -68,6 +71,7 @@ def persons_put_membership(pers_no, conf_no):
     where = int(request.json.get('where', 0))
     try:
         g.ksession.add_membership(pers_no, conf_no, priority, where)
+        invalidate_unreads(g.ksession)
         return empty_response(201)
     except (komerror.UndefinedPerson, komerror.UndefinedConference) as ex:
         return error_response(404, kom_error=ex)
@@ -109,6 +113,7 @@ def persons_delete_membership(pers_no, conf_no):
     """
     try:
         g.ksession.delete_membership(pers_no, conf_no)
+        invalidate_unreads(g.ksession)
         return empty_response(204)
     except (komerror.UndefinedPerson, komerror.UndefinedConference, komerror.NotMember) as ex:
         return error_response(404, kom_error=ex)
@@ -157,6 +162,7 @@ def persons_set_unread(conf_no):
         return error_response(400, error_msg='Missing "no_of_unread".')
     
     g.ksession.set_unread(conf_no, no_of_unread)
+    invalidate_unreads(g.ksession, conf_no)
     return empty_response(204)
 
 
@@ -170,6 +176,9 @@ def persons_get_membership(pers_no, conf_no):
     :param conf_no: Conference number
     :type conf_no: int
 
+    The "fields" and "lookups" query parameters select what to include
+    in the response (see :doc:`intro`).
+
     .. rubric:: Request
     
     ::
@@ -215,8 +224,10 @@ def persons_get_membership(pers_no, conf_no):
       curl -v -X GET "http://localhost:5001/lyskom/persons/14506/memberships/14506"
     
     """
+    lookups, fields = get_serialization_args(request.args)
     try:
-        return jsonify(to_dict(g.ksession.get_membership(pers_no, conf_no), True, g.ksession))
+        return jsonify(to_dict(g.ksession.get_membership(pers_no, conf_no), lookups, g.ksession,
+                               fields))
     except komerror.NotMember as ex:
         return error_response(404, kom_error=ex)
 
@@ -231,6 +242,9 @@ def persons_get_membership_unread(pers_no, conf_no):
     :param conf_no: Conference number
     :type conf_no: int
 
+    The "fields" query parameter selects what to include in the
+    response (see :doc:`intro`).
+
     .. rubric:: Request
     
     ::
@@ -264,13 +278,111 @@ def persons_get_membership_unread(pers_no, conf_no):
       curl -v -X GET "http://localhost:5001/lyskom/persons/14506/memberships/14506/unread"
     
     """
+    lookups, fields = get_serialization_args(request.args)
     try:
-        return jsonify(to_dict(g.ksession.get_membership_unread(pers_no, conf_no),
-                               True, g.ksession))
+        tracker = get_unread_tracker(g.ksession, pers_no)
+        membership_unread = None
+        if tracker is not None:
+            membership_unread = tracker.get_membership_unread(g.ksession, pers_no, conf_no)
+        if membership_unread is None:
+            # Not tracked (a passive membership, or not a member)
+            membership_unread = g.ksession.get_membership_unread(pers_no, conf_no)
+        return jsonify(to_dict(membership_unread, lookups, g.ksession, fields))
     except komerror.NotMember as ex:
         return error_response(404, kom_error=ex)
 
 
+@bp.route('/persons/current/memberships/<int:conf_no>/next-unread')
+@requires_login
+def persons_get_next_unread_texts(conf_no):
+    """Get the next unread texts in the current person's membership
+    for the given conference, in the order they are read in the elisp
+    client: the oldest unread text first, followed by its unread
+    footnotes and comments (depth first). The texts have the same
+    format as in texts_get. They are not marked as read.
+    
+    The texts that follow are fetched in the background, so the next
+    request (after the returned texts have been marked as read) can be
+    answered without waiting for the LysKOM server.
+    
+    :param conf_no: Conference number
+    :type conf_no: int
+    
+    Query parameters:
+    
+    =======  =======  =================================================================
+    Key      Type     Values
+    =======  =======  =================================================================
+    count    integer  Number of texts to return, at most 50. Default: 10
+    fields   string   Comma separated list of fields to include in each text (see
+                      :doc:`intro`). Default: all
+    lookups  string   ``none``, ``names`` or ``full`` (see :doc:`intro`). Default: ``full``
+    =======  =======  =================================================================
+    
+    .. rubric:: Request
+    
+    ::
+    
+      GET /<server_id>/persons/current/memberships/14506/next-unread?count=2 HTTP/1.1
+    
+    .. rubric:: Response
+    
+    ::
+    
+      HTTP/1.1 200 OK
+      
+      {
+        "no_of_unread": 17,
+        "texts": [
+          {
+            "text_no": 19831603,
+            "subject": "jaha",
+            ...
+          },
+          {
+            "text_no": 19831620,
+            "subject": "jaha",
+            ...
+          }
+        ]
+      }
+    
+    Not a member::
+    
+      HTTP/1.1 404 NOT FOUND
+    
+    .. rubric:: Example
+    
+    ::
+    
+      curl -v -X GET "http://localhost:5001/lyskom/persons/current/memberships/14506/next-unread?count=2"
+    
+    """
+    try:
+        count = int(request.args.get('count', 10))
+    except ValueError:
+        return error_response(400, error_msg='Invalid "count".')
+    if not 0 < count <= 50:
+        return error_response(400, error_msg='"count" must be between 1 and 50.')
+    lookups, fields = get_serialization_args(request.args)
+    
+    pers_no = g.ksession.get_person_no()
+    try:
+        tracker = get_unread_tracker(g.ksession, pers_no)
+        membership_unread = None
+        if tracker is not None:
+            membership_unread = tracker.get_membership_unread(g.ksession, pers_no, conf_no)
+        if membership_unread is None:
+            membership_unread = g.ksession.get_membership_unread(pers_no, conf_no)
+    except komerror.NotMember as ex:
+        return error_response(404, kom_error=ex)
+    
+    komtexts = get_next_unread_texts(g.komsession_entry, g.server, conf_no,
+                                     membership_unread.unread_texts, count)
+    return jsonify(no_of_unread=membership_unread.no_of_unread,
+                   texts=to_dict(komtexts, lookups, g.ksession, fields))
+
+
 @bp.route('/persons/<int:pers_no>/memberships/')
 @requires_login
 def persons_list_memberships(pers_no):
@@ -294,11 +406,20 @@ def persons_list_memberships(pers_no):
     passive            boolean  :true: Include passive memberships.
                                 :false: (Default) Do not include passive memberships.
     first              integer  The first position in the membership list to retrieve, numbered
-                                from 0 and up. Not possible with unread=true. Default: 0.
-    no-of-memberships  integer  The number of memberships to retrieve. Not possible with
-                                unread=true. Default: 100.
+                                from 0 and up. With unread=true, the position in the list of
+                                memberships with unread texts. Default: 0.
+    no-of-memberships  integer  The number of memberships to retrieve. Default: 100.
+    fields             string   Comma separated list of fields to include in each membership
+                                (see :doc:`intro`). Default: all
+    lookups            string   ``none``, ``names`` or ``full`` (see :doc:`intro`).
+                                Default: ``full``
     =================  =======  =================================================================
     
+    The list is streamed: it is serialized and sent a part at a time.
+    With ``Accept: application/x-ndjson``, the memberships are sent as
+    NDJSON (one per line), and has_more in the Httpkom-Has-More header
+    (see :doc:`intro`).
+    
     .. rubric:: Request
     
     ::
@@ -354,9 +475,20 @@ def persons_list_memberships(pers_no):
     passive = get_bool_arg_with_default(request.args, 'passive', False)
     first = int(request.args.get('first', 0))
     no_of_memberships = int(request.args.get('no-of-memberships', 100))
-    memberships, has_more = g.ksession.get_memberships(
-        pers_no, first, no_of_memberships, unread, passive)
-    return jsonify(has_more=has_more, memberships=to_dict(memberships, True, g.ksession))
+    lookups, fields = get_serialization_args(request.args)
+    tracker = get_unread_tracker(g.ksession, pers_no) if unread and not passive else None
+    if tracker is not None:
+        memberships = tracker.get_unread_memberships(g.ksession, pers_no)
+    else:
+        memberships, has_more = g.ksession.get_memberships(
+            pers_no, first, no_of_memberships, unread, passive)
+    if unread:
+        # All memberships with unread texts are returned, regardless
+        # of first and no_of_memberships.
+        has_more = len(memberships) > first + no_of_memberships
+        memberships = memberships[first:first + no_of_memberships]
+    chunks = to_dict_chunks(memberships, lookups, g.ksession, fields)
+    return stream_jsonify('memberships', stream_with_komsession(chunks), has_more=has_more)
 
 
 @bp.route('/persons/<int:pers_no>/memberships/unread/')
@@ -367,6 +499,13 @@ def persons_list_membership_unreads(pers_no):
     :param pers_no: Person number
     :type pers_no: int
 
+    The "fields" query parameter selects what to include for each
+    membership (see :doc:`intro`).
+
+    The list is streamed: it is serialized and sent a part at a time.
+    With ``Accept: application/x-ndjson``, the membership unreads are
+    sent as NDJSON, one per line (see :doc:`intro`).
+
     .. rubric:: Request
     
     ::
@@ -401,5 +540,11 @@ def persons_list_membership_unreads(pers_no):
       curl -v -X GET "http://localhost:5001/lyskom/persons/14506/memberships/unread/"
     
     """
-    membership_unreads = g.ksession.get_membership_unreads(pers_no)
-    return jsonify(list=to_dict(membership_unreads, True, g.ksession))
+    lookups, fields = get_serialization_args(request.args)
+    tracker = get_unread_tracker(g.ksession, pers_no)
+    if tracker is not None:
+        membership_unreads = tracker.get_membership_unreads(g.ksession, pers_no)
+    else:
+        membership_unreads = g.ksession.get_membership_unreads(pers_no)
+    chunks = to_dict_chunks(membership_unreads, lookups, g.ksession, fields)
+    return stream_jsonify('list', stream_with_komsession(chunks))
@@ -2,8 +2,12 @@
 # Copyright (C) 2012 Oskar Skoog. Released under GPL.
 
 from __future__ import absolute_import
+import hashlib
+
 from flask import request, Response, abort
 
+from .komserialization import LOOKUP_LEVELS, LOOKUPS_FULL
+
 
 def get_bool_arg_with_default(args, arg, default):
     if arg in request.args:
@@ -17,7 +21,35 @@ def get_bool_arg_with_default(args, arg, default):
         val = default
     return val
 
+def get_serialization_args(args):
+    """Get lookups and fields for komserialization.to_dict from the
+    "lookups" and "fields" query parameters. fields is None (all
+    fields) if not given.
+    """
+    lookups = args.get('lookups', LOOKUPS_FULL)
+    if lookups not in LOOKUP_LEVELS:
+        abort(400)
+    fields = args.get('fields', None)
+    if fields is not None:
+        fields = frozenset(name.strip() for name in fields.split(',') if name.strip())
+    return lookups, fields
+
 def empty_response(status, headers=None):
     response = Response("", status=status, headers=headers)
     del response.headers['Content-Type'] # text/html by default in Flask
     return response
+
+def make_etag(*parts):
+    """Make an entity tag from parts (anything with a stable repr)."""
+    return hashlib.sha1(repr(parts).encode('utf-8')).hexdigest()
+
+def is_not_modified(etag):
+    """Check if the request's If-None-Match matches etag (using weak
+    comparison, as specified for If-None-Match).
+    """
+    return request.method in ('GET', 'HEAD') and request.if_none_match.contains_weak(etag)
+
+def not_modified_response(etag, weak=False, headers=None):
+    response = empty_response(304, headers)
+    response.set_etag(etag, weak)
+    return response
@@ -0,0 +1,105 @@
+# -*- coding: utf-8 -*-
+# Copyright (C) 2012 Oskar Skoog. Released under GPL.
+
+"""Conference name cache shared by all sessions to a LysKOM server.
+
+Only names of conferences that are not secret are cached, since those
+can be looked up by anyone. Names are removed when a session gets the
+async-new-name message for the conference, when they are older than
+HTTPKOM_NAME_CACHE_TTL, and (least recently used first) when the cache
+grows over HTTPKOM_NAME_CACHE_MAX_BYTES.
+"""
+
+from __future__ import absolute_import
+import collections
+import threading
+import time
+
+from pylyskom.asyncmsg import AsyncMessages
+
+from httpkom import app
+from .pipelining import pipelined_client
+from .stats import stats
+
+
+# Rough per-entry overhead in bytes, in addition to the name.
+_ENTRY_OVERHEAD = 100
+
+
+class NameCache(object):
+    """LRU cache of conference names with a time to live and a memory
+    budget.
+    """
+    def __init__(self, stats_prefix, max_bytes, ttl):
+        self._stats_prefix = stats_prefix
+        self._max_bytes = max_bytes
+        self._ttl = ttl
+        # conf_no -> (name, expires), least recently used first
+        self._names = collections.OrderedDict()
+        self._size = 0
+        self._lock = threading.Lock()
+
+    def get(self, conf_no):
+        """Return the name of conf_no, or None if not cached."""
+        with self._lock:
+            name, expires = self._names.pop(conf_no, (None, None))
+            if name is not None:
+                if expires > time.time():
+                    self._names[conf_no] = (name, expires)
+                else:
+                    self._size -= len(name) + _ENTRY_OVERHEAD
+                    name = None
+        stats.set(self._stats_prefix + ('hits.last' if name is not None else 'misses.last'),
+                  1, agg='sum')
+        return name
+
+    def __contains__(self, conf_no):
+        with self._lock:
+            name, expires = self._names.get(conf_no, (None, None))
+            return name is not None and expires > time.time()
+
+    def set(self, conf_no, name):
+        with self._lock:
+            self._remove(conf_no)
+            self._names[conf_no] = (name, time.time() + self._ttl)
+            self._size += len(name) + _ENTRY_OVERHEAD
+            while self._size > self._max_bytes and self._names:
+                self._remove(next(iter(self._names)))
+            stats.set(self._stats_prefix + 'bytes.last', self._size, agg='last')
+
+    def invalidate(self, conf_no):
+        with self._lock:
+            self._remove(conf_no)
+
+    def _remove(self, conf_no):
+        name, expires = self._names.pop(conf_no, (None, None))
+        if name is not None:
+            self._size -= len(name) + _ENTRY_OVERHEAD
+
+
+_name_caches = {}
+_name_caches_lock = threading.Lock()
+
+def get_name_cache(server):
+    with _name_caches_lock:
+        if server.id not in _name_caches:
+            _name_caches[server.id] = NameCache(
+                'namecache.{}.'.format(server.id),
+                app.config['HTTPKOM_NAME_CACHE_MAX_BYTES'],
+                app.config['HTTPKOM_NAME_CACHE_TTL'])
+        return _name_caches[server.id]
+
+
+def attach_name_cache(ksession, server):
+    """Make the session use the server's shared name cache. Does
+    nothing for sessions that are not owned by this process.
+    """
+    client = pipelined_client(ksession)
+    if client is None:
+        return
+
+    cache = get_name_cache(server)
+    def new_name_handler(msg):
+        cache.invalidate(msg.conf_no)
+    client.register_async_handler(AsyncMessages.NEW_NAME, new_name_handler)
+    client.name_cache = cache
@@ -0,0 +1,193 @@
+# -*- coding: utf-8 -*-
+# Copyright (C) 2012 Oskar Skoog. Released under GPL.
+
+"""Local index of conference names for name expansion.
+
+The index is built from a snapshot of all conference names (a lookup
+of the empty name, which matches everything) using a shared, not
+logged in, session. It is kept current with async-new-name messages,
+persons created through httpkom, and a periodic rebuild
+(HTTPKOM_NAME_INDEX_REFRESH).
+
+Names are matched according to the KOM conventions: parenthesized
+parts are ignored, case is ignored (with the Swedish 7-bit characters
+equal to their 8-bit counterparts), and each word of the pattern must
+be a prefix of the corresponding word of the name.
+
+Since the snapshot is made without logging in, secret conferences are
+never in the index.
+"""
+
+from __future__ import absolute_import
+import bisect
+import logging
+import re
+import threading
+import time
+
+import six
+from pylyskom.asyncmsg import AsyncMessages
+
+from httpkom import app
+from .pipelining import pipelined_client
+
+
+log = logging.getLogger("httpkom.nameindex")
+
+_parenthesized = re.compile(r'\([^)]*\)?')
+_collate = dict((ord(a), b) for a, b in [ (u'[', u'ä'), (u'{', u'ä'),
+                                          (u'\\', u'ö'), (u'|', u'ö'),
+                                          (u']', u'å'), (u'}', u'å') ])
+
+
+def _to_text(name):
+    if isinstance(name, six.binary_type):
+        return name.decode('latin-1')
+    return name
+
+def name_words(name):
+    """Split a name (or pattern) into normalized words."""
+    name = _parenthesized.sub(u' ', _to_text(name))
+    return tuple(name.lower().translate(_collate).split())
+
+def _matches(pattern_words, words):
+    if len(pattern_words) > len(words):
+        return False
+    for pattern_word, word in zip(pattern_words, words):
+        if not word.startswith(pattern_word):
+            return False
+    return True
+
+
+class NameIndex(object):
+    """Index of conference names, for name expansion without asking
+    the LysKOM server.
+    """
+    def __init__(self):
+        # conf_no -> (name, words, is_person)
+        self._confs = {}
+        # Sorted (first word, conf_no), for finding the names whose
+        # first word starts with a prefix.
+        self._first_words = []
+        self._lock = threading.Lock()
+        self.updated = None
+
+    def build(self, entries):
+        """Replace the contents with entries: (conf_no, name, is_person)."""
+        confs = {}
+        for conf_no, name, is_person in entries:
+            confs[conf_no] = (_to_text(name), name_words(name), is_person)
+        first_words = sorted((words[0] if words else u'', conf_no)
+                             for conf_no, (name, words, is_person) in confs.items())
+        with self._lock:
+            self._confs = confs
+            self._first_words = first_words
+            self.updated = time.time()
+
+    def set_name(self, conf_no, name, is_person=None):
+        """Add or rename a conference. If is_person is None, the
+        conference must already be in the index.
+        """
+        with self._lock:
+            if conf_no in self._confs:
+                old_name, old_words, old_is_person = self._confs[conf_no]
+                self._first_words.remove((old_words[0] if old_words else u'', conf_no))
+                if is_person is None:
+                    is_person = old_is_person
+            elif is_person is None:
+                return
+            words = name_words(name)
+            self._confs[conf_no] = (_to_text(name), words, is_person)
+            bisect.insort(self._first_words, (words[0] if words else u'', conf_no))
+
+    def lookup(self, name, want_pers, want_confs):
+        """Return a list of (conf_no, name) tuples, like
+        KomSession.lookup_name.
+        """
+        pattern_words = name_words(name)
+        with self._lock:
+            if pattern_words:
+                prefix = pattern_words[0]
+                start = bisect.bisect_left(self._first_words, (prefix, -1))
+                candidates = []
+                for first_word, conf_no in self._first_words[start:]:
+                    if not first_word.startswith(prefix):
+                        break
+                    candidates.append(conf_no)
+            else:
+                candidates = list(self._confs.keys())
+
+            result = []
+            for conf_no in candidates:
+                conf_name, words, is_person = self._confs[conf_no]
+                if (want_pers if is_person else want_confs) and _matches(pattern_words, words):
+                    result.append((conf_no, conf_name))
+        result.sort()
+        return result
+
+
+_name_indexes = {}
+_name_indexes_lock = threading.Lock()
+
+def get_name_index(server):
+    """Return the server's index, or None if it is disabled or has not
+    been built yet.
+    """
+    if not app.config['HTTPKOM_NAME_INDEX']:
+        return None
+    with _name_indexes_lock:
+        index = _name_indexes.get(server.id, None)
+    if index is None or index.updated is None:
+        return None
+    return index
+
+
+def update_name_index(server, lookup_name):
+    """Rebuild the server's index from a snapshot of all names, using
+    lookup_name(name, want_pers, want_confs).
+    """
+    persons = lookup_name(u'', True, False)
+    confs = lookup_name(u'', False, True)
+    entries = [ (conf_no, name, True) for conf_no, name in persons ] + \
+              [ (conf_no, name, False) for conf_no, name in confs ]
+    with _name_indexes_lock:
+        index = _name_indexes.setdefault(server.id, NameIndex())
+    index.build(entries)
+    log.info("Name index for %s updated with %d names", server.id, len(entries))
+
+
+class NameIndexUpdater(threading.Thread):
+    """Background thread that rebuilds the index for a server every
+    interval seconds (see update_name_index).
+    """
+    def __init__(self, server, lookup_name, interval):
+        threading.Thread.__init__(self, name="httpkom-name-index-{}".format(server.id))
+        self.daemon = True
+        self._server = server
+        self._lookup_name = lookup_name
+        self._interval = interval
+
+    def run(self):
+        while True:
+            try:
+                update_name_index(self._server, self._lookup_name)
+            except Exception:
+                log.exception("Failed to update name index for %s", self._server.id)
+            time.sleep(self._interval)
+
+
+def attach_name_index(ksession, server):
+    """Let the session's async-new-name messages update the server's
+    index. Does nothing for sessions that are not owned by this
+    process.
+    """
+    client = pipelined_client(ksession)
+    if not app.config['HTTPKOM_NAME_INDEX'] or client is None:
+        return
+
+    def new_name_handler(msg):
+        with _name_indexes_lock:
+            index = _name_indexes.get(server.id, None)
+        if index is not None:
+            index.set_name(msg.conf_no, _to_text(msg.new_name))
+    client.register_async_handler(AsyncMessages.NEW_NAME, new_name_handler)
@@ -2,7 +2,7 @@
 # Copyright (C) 2012 Oskar Skoog. Released under GPL.
 
 from __future__ import absolute_import
-from flask import g, request, jsonify
+from flask import g, request
 
 import pylyskom.errors as komerror
 
@@ -10,6 +10,8 @@ from .komserialization import to_dict
 
 from httpkom import bp
 from .errors import error_response
+from .jsonresponse import jsonify
+from .nameindex import get_name_index
 from .sessions import requires_session, requires_login
 from .misc import empty_response
 
@@ -67,6 +69,9 @@ def persons_create():
     
     try:
         kom_person = g.ksession.create_person(name, passwd)
+        name_index = get_name_index(g.server)
+        if name_index is not None:
+            name_index.set_name(kom_person.pers_no, name, is_person=True)
         return jsonify(to_dict(kom_person, True, g.ksession)), 201
     except komerror.Error as ex:
         return error_response(400, kom_error=ex)
@@ -0,0 +1,320 @@
+# -*- coding: utf-8 -*-
+# Copyright (C) 2012 Oskar Skoog. Released under GPL.
+
+"""Protocol A pipelining.
+
+Protocol A tags each call with a reference number, so one connection
+can have many calls in flight and the replies are matched by the
+reference number. pylyskom's Client sends a call and then reads
+replies until it gets the one for the call, queueing the replies for
+other reference numbers on the way.
+
+PipelinedClient splits that into send() and response(), so that
+several calls can be sent before waiting for any of the replies, and
+makes it safe to do from several threads at once. pylyskom's
+Connection holds the same lock while sending and while blocking on
+the socket for a reply, so PipelinedConnection reads under a lock of
+its own: a thread that is waiting for a reply does not stop other
+threads from sending their calls. The replies for the other threads
+are queued, and picked up when they get to read.
+"""
+
+from __future__ import absolute_import
+import select
+import socket
+import threading
+
+from pylyskom import errors, requests
+from pylyskom.cachedconnection import CachingPersonClient, Client
+from pylyskom.connection import Connection
+from pylyskom.komsession import KomSession, KomText
+
+
+class PipelinedConnection(Connection):
+    """Connection where sending (serialized by _lock) and reading
+    (serialized by _recv_lock) can be done by different threads at the
+    same time.
+    """
+    def __init__(self, sock, user=None):
+        self._recv_lock = threading.RLock()
+        Connection.__init__(self, sock, user)
+
+    def read_response(self):
+        with self._recv_lock:
+            return self._parse_response()
+
+    def has_waiting_data(self):
+        """Check, without blocking, if a message (a reply or an async
+        message) has started to arrive. Must be called holding
+        _recv_lock.
+        """
+        buf = self._buffer
+        # Whitespace (such as the newline after the last reply) is not
+        # the start of a message.
+        while not buf._rb[buf._rb_pos:].strip():
+            if not select.select([ self._socket ], [], [], 0)[0]:
+                return False
+            data = self._socket.recv(4096)
+            if not data:
+                raise errors.ReceiveError()
+            buf._rb = buf._rb[buf._rb_pos:] + data
+            buf._rb_pos = 0
+            buf._rb_len = len(buf._rb)
+        return True
+
+    def _send_request(self, req):
+        # The request must be known before it is sent, since another
+        # thread can read the reply before the send returns.
+        self._ref_no += 1
+        ref_no = self._ref_no
+        self._outstanding_requests[ref_no] = req
+        self._send_string(b"%d %s" % (ref_no, req.to_string()))
+        return ref_no
+
+
+class PipelinedClient(Client):
+    def __init__(self, conn):
+        Client.__init__(self, conn)
+        self._recv_lock = threading.RLock()
+
+    def send(self, request):
+        """Send a call without waiting for its reply. Returns the
+        reference number to pass to response().
+        """
+        return self._conn.send_request(request)
+
+    def response(self, ref_no):
+        """Wait for the reply to a call made with send(). Returns the
+        response or raises the error.
+        """
+        return self._wait_and_dequeue(ref_no)
+
+    def read_waiting_messages(self):
+        """Read the messages that have already arrived on the
+        connection, without waiting for more. Async messages are
+        handled, and replies queued for response().
+        """
+        with self._recv_lock:
+            while self._conn.has_waiting_data():
+                self._read_response()
+
+    def _wait_and_dequeue(self, ref_no):
+        with self._recv_lock:
+            return Client._wait_and_dequeue(self, ref_no)
+
+
+class PipelinedPersonClient(CachingPersonClient):
+    def __init__(self, client):
+        # Shared name cache, see httpkom.namecache.
+        self.name_cache = None
+        # See httpkom.unreads.
+        self.unread_tracker = None
+        CachingPersonClient.__init__(self, client)
+
+    def send(self, request):
+        return self._client.send(request)
+
+    def response(self, ref_no):
+        return self._client.response(ref_no)
+
+    def handle_async_messages(self):
+        """Handle the async messages that have arrived so far, without
+        a call to the server.
+        """
+        self._client.read_waiting_messages()
+
+    def conf_name(self, conf_no, default="", include_no=0):
+        if self.name_cache is None or include_no:
+            return CachingPersonClient.conf_name(self, conf_no, default, include_no)
+
+        name = self.name_cache.get(conf_no)
+        if name is None:
+            name = CachingPersonClient.conf_name(self, conf_no, default)
+            uconf = self.uconferences.dict.get(conf_no, None)
+            # Names of secret conferences must not be shared with
+            # other sessions.
+            if uconf is not None and not uconf.type.secret:
+                self.name_cache.set(conf_no, name)
+        return name
+
+
+def _create_client(host, port, user):
+    s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    s.connect((host, port))
+    return PipelinedPersonClient(PipelinedClient(PipelinedConnection(s, user)))
+
+def new_komsession():
+    """Create a KomSession whose connection can be used by several
+    threads at the same time.
+    """
+    return KomSession(client_factory=_create_client)
+
+def pipelined_client(ksession):
+    """Return the PipelinedPersonClient of a session created by
+    new_komsession, or None for sessions that are not owned by this
+    process (see httpkom.broker).
+    """
+    client = getattr(ksession, '_client', None)
+    if isinstance(client, PipelinedPersonClient):
+        return client
+    return None
+
+
+def _send_requests(client, cache, make_request, numbers):
+    pending = []
+    for no in numbers:
+        if no not in cache.dict:
+            pending.append((no, client.send(make_request(no))))
+    return pending
+
+def _store_responses(client, cache, pending):
+    for no, ref_no in pending:
+        try:
+            cache[no] = client.response(ref_no)
+        except errors.ServerError:
+            # Not cached, so the error will be raised again (and
+            # handled) when the value is used.
+            pass
+
+def prefetch(ksession, conf_nos=(), text_nos=(), author_conf_nos=True):
+    """Fetch the given conferences and text stats into the caches of
+    the session's connection, sending all calls before waiting for
+    any of the replies. If author_conf_nos is True, the names of the
+    authors of the texts are also prefetched.
+
+    Does nothing for sessions that are not owned by this process.
+    """
+    client = pipelined_client(ksession)
+    if client is None:
+        return
+
+    text_nos = set(text_nos)
+    conf_nos = set(conf_nos)
+    pending_texts = _send_requests(client, client.textstats, requests.ReqGetTextStat, text_nos)
+    if client.name_cache is not None:
+        conf_nos = set(no for no in conf_nos if no not in client.name_cache)
+    pending_confs = _send_requests(client, client.uconferences, requests.ReqGetUconfStat, conf_nos)
+    _store_responses(client, client.textstats, pending_texts)
+
+    if author_conf_nos:
+        authors = set(client.textstats[no].author for no in text_nos
+                      if no in client.textstats.dict)
+        if client.name_cache is not None:
+            authors = set(no for no in authors if no not in client.name_cache)
+        pending_confs.extend(_send_requests(client, client.uconferences, requests.ReqGetUconfStat,
+                                            authors - conf_nos))
+    _store_responses(client, client.uconferences, pending_confs)
+
+
+def fetch_texts(ksession, text_nos, ignored_errors=(errors.NoSuchText, errors.TextZero)):
+    """Get several texts, sending all calls before waiting for any of
+    the replies. Returns a dict from text number to KomText, or to the
+    error if getting the text raised one of ignored_errors.
+    """
+    result = {}
+    client = pipelined_client(ksession)
+    if client is not None:
+        prefetch(ksession, text_nos=text_nos, author_conf_nos=False)
+        pending = [ (no, client.send(requests.ReqGetText(no)))
+                    for no in text_nos if no in client.textstats.dict ]
+        for no, ref_no in pending:
+            try:
+                result[no] = KomText(text_no=no, text=client.response(ref_no),
+                                     text_stat=client.textstats[no])
+            except ignored_errors as ex:
+                result[no] = ex
+
+    for no in text_nos:
+        if no not in result:
+            try:
+                result[no] = ksession.get_text(no)
+            except ignored_errors as ex:
+                result[no] = ex
+    return result
+
+
+# Max number of local text numbers in one mark-as-read call.
+_MARK_AS_READ_CHUNK = 100
+
+def _response_error(client, ref_no):
+    try:
+        client.response(ref_no)
+    except errors.ServerError as ex:
+        return ex
+    return None
+
+def mark_as_read(ksession, text_nos=(), local_text_nos=()):
+    """Mark texts as read, sending all calls before waiting for any of
+    the replies. text_nos are marked as read in all recipients where
+    the person is a member. local_text_nos are (conf_no, local_nos)
+    tuples, and the local texts are marked as read in conf_no.
+    
+    Returns a dict from text number to the error (or None), and a list
+    with the error (or None) for each item in local_text_nos. A text
+    that could not be marked as read in any of its recipients (for
+    example because the person is not a member of any of them) gets
+    the error from one of them.
+    """
+    client = pipelined_client(ksession)
+    text_errors = {}
+    local_errors = [ None ] * len(local_text_nos)
+    if client is None:
+        for no in text_nos:
+            try:
+                ksession.mark_as_read(no)
+                text_errors[no] = None
+            except errors.ServerError as ex:
+                text_errors[no] = ex
+        for i, (conf_no, local_nos) in enumerate(local_text_nos):
+            try:
+                for local_no in local_nos:
+                    ksession._client.mark_as_read_local(conf_no, local_no)
+            except errors.ServerError as ex:
+                local_errors[i] = ex
+        return text_errors, local_errors
+
+    prefetch(ksession, text_nos=text_nos, author_conf_nos=False)
+    # conf_no -> { local_no: text_no } for text_nos
+    by_conf = {}
+    for no in text_nos:
+        try:
+            text_stat = client.textstats[no]
+        except errors.ServerError as ex:
+            text_errors[no] = ex
+            continue
+        for mir in text_stat.misc_info.recipient_list:
+            by_conf.setdefault(mir.recpt, {})[mir.loc_no] = no
+
+    def send(conf_no, local_nos):
+        chunks = [ local_nos[i:i + _MARK_AS_READ_CHUNK]
+                   for i in range(0, len(local_nos), _MARK_AS_READ_CHUNK) ]
+        return [ (client.send(requests.ReqMarkAsRead(conf_no, chunk)), chunk) for chunk in chunks ]
+    pending_texts = [ (conf_no, send(conf_no, sorted(local_to_text)))
+                      for conf_no, local_to_text in by_conf.items() ]
+    pending_locals = [ send(conf_no, list(local_nos)) for conf_no, local_nos in local_text_nos ]
+
+    marked = set()
+    failed = {}
+    for conf_no, pending in pending_texts:
+        for ref_no, chunk in pending:
+            error = _response_error(client, ref_no)
+            for local_no in chunk:
+                no = by_conf[conf_no][local_no]
+                if error is None:
+                    marked.add(no)
+                else:
+                    failed.setdefault(no, error)
+    for i, pending in enumerate(pending_locals):
+        for ref_no, chunk in pending:
+            error = _response_error(client, ref_no)
+            if local_errors[i] is None:
+                local_errors[i] = error
+    for no in text_nos:
+        if no not in text_errors:
+            text_errors[no] = None if no in marked else failed.get(no)
+
+    # The cached memberships have the time the conference was last
+    # read, which marking texts as read changes.
+    for conf_no in set(by_conf) | set(conf_no for conf_no, local_nos in local_text_nos):
+        client._invalidate_membership(conf_no)
+    return text_errors, local_errors
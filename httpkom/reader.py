@@ -0,0 +1,115 @@
+# -*- coding: utf-8 -*-
+# Copyright (C) 2012 Oskar Skoog. Released under GPL.
+
+"""Reading the unread texts of a conference in order.
+
+The texts are read in the same order as in the elisp client: the
+oldest unread text in the conference, then its unread footnotes and
+comments (depth first), before the next unread text in the
+conference.
+
+When a client gets the next unread texts, the texts after them are
+fetched in the background, so they are ready when the client (having
+read the first ones) asks for the next unread texts again.
+"""
+
+from __future__ import absolute_import
+import logging
+import threading
+import time
+import weakref
+
+from pylyskom import datatypes, errors
+
+from .pipelining import prefetch
+from .textcache import get_texts
+
+
+log = logging.getLogger("httpkom.reader")
+
+# Seconds that texts fetched in the background are used. Their text
+# stats might be out of date after that.
+_PREFETCH_TTL = 30
+
+# ksession -> (conf_no, fetched_at, { text_no: KomText })
+_prefetched = weakref.WeakKeyDictionary()
+_prefetched_lock = threading.Lock()
+
+
+def reading_order(ksession, unread_text_nos, count):
+    """Return the first count of unread_text_nos in reading order."""
+    unread = set(unread_text_nos)
+    roots = iter(sorted(unread))
+    prefetch(ksession, text_nos=sorted(unread)[:count], author_conf_nos=False)
+
+    order = []
+    visited = set()
+    stack = []
+    while len(order) < count:
+        if not stack:
+            root = next((no for no in roots if no not in visited), None)
+            if root is None:
+                break
+            stack.append(root)
+        text_no = stack.pop()
+        if text_no in visited:
+            continue
+        visited.add(text_no)
+        try:
+            text_stat = ksession.get_text_stat(text_no)
+        except (errors.NoSuchText, errors.TextZero):
+            # Deleted, or not readable for the person
+            continue
+        order.append(text_no)
+
+        comments = [ c for c in text_stat.misc_info.comment_in_list
+                     if c.text_no in unread and c.text_no not in visited ]
+        # Footnotes before comments, each in the order they were added.
+        comments.sort(key=lambda c: c.type != datatypes.MIC_FOOTNOTE)
+        prefetch(ksession, text_nos=[ c.text_no for c in comments ], author_conf_nos=False)
+        stack.extend(reversed([ c.text_no for c in comments ]))
+    return order
+
+
+def _take_prefetched(ksession, conf_no):
+    with _prefetched_lock:
+        prefetched = _prefetched.pop(ksession, None)
+    if prefetched is None:
+        return {}
+    prefetched_conf_no, fetched_at, texts = prefetched
+    if prefetched_conf_no != conf_no or time.time() - fetched_at > _PREFETCH_TTL:
+        return {}
+    return texts
+
+def _prefetch_in_background(entry, server, conf_no, text_nos):
+    def run():
+        try:
+            with entry.lock.shared():
+                texts = get_texts(entry.ksession, server, text_nos)
+        except Exception:
+            log.exception("Failed to prefetch texts")
+            return
+        texts = dict((no, t) for no, t in texts.items() if not isinstance(t, errors.Error))
+        with _prefetched_lock:
+            _prefetched[entry.ksession] = (conf_no, time.time(), texts)
+    thread = threading.Thread(target=run, name="httpkom-reader-prefetch")
+    thread.daemon = True
+    thread.start()
+
+
+def get_next_unread_texts(entry, server, conf_no, unread_text_nos, count):
+    """Return the next count unread texts (KomTexts) in conf_no, in
+    reading order, using the session in entry. The count texts after
+    them are then fetched in the background.
+    """
+    ksession = entry.ksession
+    order = reading_order(ksession, unread_text_nos, 2 * count)
+    text_nos, next_text_nos = order[:count], order[count:]
+
+    texts = _take_prefetched(ksession, conf_no)
+    missing = [ no for no in text_nos if no not in texts ]
+    if missing:
+        texts.update(get_texts(ksession, server, missing))
+    if next_text_nos:
+        _prefetch_in_background(entry, server, conf_no, next_text_nos)
+    return [ texts[no] for no in text_nos if not isinstance(texts[no], errors.Error) ]
@@ -0,0 +1,83 @@
+# -*- coding: utf-8 -*-
+# Copyright (C) 2012 Oskar Skoog. Released under GPL.
+
+"""Pools of connected, not logged in, KomSessions.
+
+Connecting a KomSession means a TCP connect, the Protocol A handshake
+and the client information calls. A pool keeps a few sessions that
+are ready to be handed out, and refills itself in a background
+thread.
+
+The client name and version are sent to the LysKOM server when the
+session is connected, so there is one pool per server and client.
+"""
+
+from __future__ import absolute_import
+import collections
+import logging
+import threading
+import time
+
+from .stats import stats
+
+
+log = logging.getLogger("httpkom.sessionpool")
+
+
+class KomSessionPool(threading.Thread):
+    """A pool of up to size sessions, opened with open_session() and
+    closed with close_session(ksession). Sessions older than max_age
+    seconds are closed and replaced, so the LysKOM server doesn't time
+    them out while pooled.
+    """
+    def __init__(self, open_session, close_session, size, max_age=None):
+        threading.Thread.__init__(self, name="httpkom-session-pool")
+        self.daemon = True
+        self._open_session = open_session
+        self._close_session = close_session
+        self._size = size
+        self._max_age = max_age
+        # (created, ksession, session_no), newest first
+        self._sessions = collections.deque()
+        self._lock = threading.Lock()
+        self._wakeup = threading.Event()
+
+    def get(self):
+        """Return a (ksession, session_no) tuple, or None if the pool
+        is empty.
+        """
+        self._wakeup.set()
+        while True:
+            with self._lock:
+                if not self._sessions:
+                    stats.set('sessions.pool.misses.last', 1, agg='sum')
+                    return None
+                created, ksession, session_no = self._sessions.popleft()
+            if ksession.is_connected():
+                stats.set('sessions.pool.hits.last', 1, agg='sum')
+                return ksession, session_no
+
+    def run(self):
+        while True:
+            self._discard_old()
+            while len(self._sessions) < self._size:
+                try:
+                    ksession = self._open_session()
+                    session_no = ksession.who_am_i()
+                except Exception:
+                    log.exception("Failed to open pooled session")
+                    break
+                with self._lock:
+                    self._sessions.appendleft((time.time(), ksession, session_no))
+            self._wakeup.wait(self._max_age)
+            self._wakeup.clear()
+
+    def _discard_old(self):
+        if self._max_age is None:
+            return
+        old = []
+        with self._lock:
+            while self._sessions and time.time() - self._sessions[-1][0] > self._max_age:
+                old.append(self._sessions.pop())
+        for created, ksession, session_no in old:
+            self._close_session(ksession)
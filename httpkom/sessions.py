@@ -12,7 +12,11 @@ The session number is what the LysKOM server uses to identify an open
 connection.
 
 There is a 1-to-1 relation between httpkom connection ids and LysKOM
-session numbers. The important difference between the session number
+session numbers, unless HTTPKOM_SHARE_PERSON_SESSIONS is set. Then all
+connection ids that are logged in as the same person share one LysKOM
+session (and its caches). A connection id is pointed to the shared
+session after a successful login, and is given a new session when it
+logs out. The important difference between the session number
 and the connection id, is that the session number is not
 secret. Httpkom uses a separate connection identifier, the httpkom
 connection id (a random UUID), to make it close to impossible to
@@ -92,59 +96,498 @@ perspective to have them different resources (i.e. different
 """
 
 from __future__ import absolute_import
+import collections
+import contextlib
 import errno
 import functools
+import itertools
 import socket
+import threading
+import time
 import uuid
 
-from flask import g, request, jsonify
+from flask import g, request, stream_with_context
 
 import pylyskom.errors as komerror
-from pylyskom.komsession import KomSession, KomPerson, KomSessionNotConnected
+from pylyskom.komsession import KomPerson, KomSessionNotConnected
 
 from .komserialization import to_dict
 
-from httpkom import HTTPKOM_CONNECTION_HEADER, bp
+from httpkom import HTTPKOM_CONNECTION_HEADER, _servers, app, bp
+from .broker import BrokerClient, RemoteKomSession
 from .errors import error_response
-from .misc import empty_response
+from .jsonresponse import jsonify
+from .misc import empty_response, get_serialization_args
+from .namecache import attach_name_cache
+from .nameindex import NameIndexUpdater, attach_name_index
+from .pipelining import new_komsession
+from .sessionpool import KomSessionPool
 from .stats import stats
+from .textcache import attach_text_cache
+from .unreads import attach_unread_tracker
+from .version import __version__
 
 
 # These komsessions methods are the only ones that should access the
-# _komsessions object
-
-_komsessions = {}
-
-def _open_komsession(host, port, client_name, client_version):
-    komsession = KomSession()
+# _komsessions object. Requests are served by several threads, so all
+# access to _komsessions must be done while holding _komsessions_lock.
+#
+# _komsessions is ordered by last use (least recently used first).
+#
+# _person_komsessions has the entries that are shared by all
+# connection ids that are logged in as a person, by (server id,
+# pers_no). Only used if HTTPKOM_SHARE_PERSON_SESSIONS is set.
+
+_komsessions = collections.OrderedDict()
+_person_komsessions = {}
+_komsessions_lock = threading.RLock()
+
+
+class _SessionLock(object):
+    """Reader-writer lock for a KomSession. Requests that only read
+    (GET and HEAD) can use the session at the same time, and their
+    LysKOM calls are then pipelined on the connection. Other requests
+    can change the state of the session, so they use it exclusively.
+    """
+    def __init__(self):
+        self._cond = threading.Condition(threading.Lock())
+        self._readers = 0
+        self._writer = False
+        self._writers_waiting = 0
+
+    @contextlib.contextmanager
+    def shared(self):
+        with self._cond:
+            while self._writer or self._writers_waiting > 0:
+                self._cond.wait()
+            self._readers += 1
+        try:
+            yield
+        finally:
+            with self._cond:
+                self._readers -= 1
+                if self._readers == 0:
+                    self._cond.notify_all()
+
+    @contextlib.contextmanager
+    def exclusive(self):
+        with self._cond:
+            self._writers_waiting += 1
+            while self._writer or self._readers > 0:
+                self._cond.wait()
+            self._writers_waiting -= 1
+            self._writer = True
+        try:
+            yield
+        finally:
+            self.release_exclusive()
+
+    def try_exclusive(self):
+        """Take the lock exclusively if no one is using or waiting for
+        it, without blocking. Returns True if it was taken, and it
+        must then be released with release_exclusive().
+        """
+        with self._cond:
+            if self._writer or self._readers > 0 or self._writers_waiting > 0:
+                return False
+            self._writer = True
+            return True
+
+    def release_exclusive(self):
+        with self._cond:
+            self._writer = False
+            self._cond.notify_all()
+
+    def for_method(self, method):
+        if method in ('GET', 'HEAD'):
+            return self.shared()
+        return self.exclusive()
+
+
+class _KomSessionEntry(object):
+    """A KomSession in the registry, together with the lock that
+    controls which requests can use the session at the same time.
+    
+    Several connection ids can refer to the same entry (see
+    _register_login), refcount is the number of connection ids that
+    do.
+    """
+    def __init__(self, ksession, client=None):
+        self.ksession = ksession
+        self.lock = _SessionLock()
+        self.last_used = time.time()
+        self.refcount = 0
+        # (client name, client version)
+        self.client = client
+        # (server id, pers_no) if shared by the person's connection ids
+        self.person_key = None
+
+_broker_client = None
+if app.config['HTTPKOM_BROKER_SOCKET'] is not None:
+    _broker_client = BrokerClient(app.config['HTTPKOM_BROKER_SOCKET'])
+
+class _CachedValue(object):
+    """A value that is computed by func(*args) and recomputed when it
+    is older than max_age seconds.
+    """
+    def __init__(self, func, max_age):
+        self._func = func
+        self._max_age = max_age
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def get(self, *args):
+        with self._lock:
+            value, updated = self._values.get(args, (None, None))
+        if updated is None or time.time() - updated > self._max_age:
+            value = self._func(*args)
+            with self._lock:
+                self._values[args] = (value, time.time())
+        return value
+
+def _resolve_address(host, port):
+    return socket.getaddrinfo(host, port, 0, socket.SOCK_STREAM)[0][4][0]
+
+_fqdn = _CachedValue(socket.getfqdn, 60 * 60)
+_server_addresses = _CachedValue(_resolve_address, 5 * 60)
+
+def _open_komsession(server, client_name, client_version):
+    if _broker_client is None:
+        komsession = new_komsession()
+    else:
+        komsession = RemoteKomSession(_broker_client, _new_connection_id())
     komsession.connect(
-        host, port,
-        "httpkom", socket.getfqdn(),
+        _server_addresses.get(server.host, server.port), server.port,
+        "httpkom", _fqdn.get(),
         client_name, client_version)
+    attach_name_cache(komsession, server)
+    attach_text_cache(komsession, server)
+    attach_name_index(komsession, server)
+    attach_unread_tracker(komsession)
     stats.set('sessions.komsessions.connected.last', 1, agg='sum')
     return komsession
 
-def _save_komsession(ksession):
-    connection_id = _new_connection_id()
-    assert connection_id not in _komsessions, "Komsession ID already used: {}".format(connection_id)
-    _komsessions[connection_id] = ksession
+def _close_komsession(ksession):
+    try:
+        ksession.disconnect(0)
+    except Exception:
+        app.logger.exception("Failed to disconnect session")
+    if isinstance(ksession, RemoteKomSession):
+        ksession.release()
+
+# Shared, not logged in, sessions by server id. Used for requests
+# without a Httpkom-Connection (see allows_shared_session).
+_shared_komsessions = {}
+_shared_komsessions_lock = threading.Lock()
+_shared_komsessions_counter = itertools.count()
+
+# Session pools by (server id, client name, client version).
+_komsession_pools = {}
+_komsession_pools_lock = threading.Lock()
+
+def _get_komsession_pool(server, client_name, client_version):
+    key = (server.id, client_name, client_version)
+    with _komsession_pools_lock:
+        pool = _komsession_pools.get(key, None)
+        if pool is None and len(_komsession_pools) < app.config['HTTPKOM_SESSION_POOL_MAX_CLIENTS']:
+            pool = KomSessionPool(
+                functools.partial(_open_komsession, server, client_name, client_version),
+                _close_komsession,
+                app.config['HTTPKOM_SESSION_POOL_SIZE'],
+                app.config['HTTPKOM_SESSION_POOL_MAX_AGE'])
+            pool.start()
+            _komsession_pools[key] = pool
+    return pool
+
+def _open_or_reuse_komsession(server, client_name, client_version):
+    """Return a connected (ksession, session_no), from the pool if
+    possible.
+    """
+    if app.config['HTTPKOM_SESSION_POOL_SIZE'] > 0:
+        pool = _get_komsession_pool(server, client_name, client_version)
+        if pool is not None:
+            pooled = pool.get()
+            if pooled is not None:
+                return pooled
+    ksession = _open_komsession(server, client_name, client_version)
+    return ksession, ksession.who_am_i()
+
+def _save_komsession(ksession, client=None):
+    if isinstance(ksession, RemoteKomSession):
+        # The broker already knows the session by this id.
+        connection_id = ksession.connection_id
+    else:
+        connection_id = _new_connection_id()
+    with _komsessions_lock:
+        assert connection_id not in _komsessions, "Komsession ID already used: {}".format(connection_id)
+        _point_connection_id(connection_id, _KomSessionEntry(ksession, client))
+        evicted = _pop_lru_komsessions(app.config['HTTPKOM_MAX_SESSIONS'])
     stats.set('sessions.komsessions.saved.last', 1, agg='sum')
+    _disconnect_evicted(evicted, 'lru')
     return connection_id
 
 def _delete_komsession(connection_id):
     if connection_id is None:
         return
-    if connection_id in _komsessions:
-        del _komsessions[connection_id]
+    with _komsessions_lock:
+        entry = _komsessions.pop(connection_id, None)
+        unreferenced = entry is not None and _release_entry(entry)
+    if entry is not None:
+        if unreferenced and isinstance(entry.ksession, RemoteKomSession):
+            entry.ksession.release()
         stats.set('sessions.komsessions.deleted.last', 1, agg='sum')
 
-def _get_komsession(connection_id):
-    stats.set('sessions.komsessions.active.last', len(_komsessions), agg='last')
-    return _komsessions.get(connection_id, None)
+def _get_komsession_entry(connection_id):
+    with _komsessions_lock:
+        stats.set('sessions.komsessions.active.last', len(_komsessions), agg='last')
+        entry = _komsessions.pop(connection_id, None)
+        if entry is not None:
+            # Move to the end, as the most recently used.
+            _komsessions[connection_id] = entry
+            entry.last_used = time.time()
+    if entry is None and connection_id is not None and _broker_client is not None:
+        # The session might have been created by another HTTP
+        # process, or before this process was restarted.
+        ksession = RemoteKomSession(_broker_client, connection_id)
+        if ksession.exists():
+            with _komsessions_lock:
+                entry = _komsessions.get(connection_id, None)
+                if entry is None:
+                    entry = _KomSessionEntry(ksession)
+                    _point_connection_id(connection_id, entry)
+    return entry
+
+def _point_connection_id(connection_id, entry):
+    """Make connection_id refer to entry. Returns the entry that
+    connection_id referred to before, if no connection id refers to it
+    anymore (so it should be closed), otherwise None.
+    """
+    with _komsessions_lock:
+        old_entry = _komsessions.pop(connection_id, None)
+        _komsessions[connection_id] = entry
+        entry.refcount += 1
+        if old_entry is not None and _release_entry(old_entry):
+            return old_entry
+    return None
+
+def _release_entry(entry):
+    """Decrease the reference count of entry. Returns True if no
+    connection id refers to it anymore. Must be called with
+    _komsessions_lock held.
+    """
+    entry.refcount -= 1
+    if entry.refcount > 0:
+        return False
+    _unshare_entry(entry)
+    return True
+
+def _unshare_entry(entry):
+    """Must be called with _komsessions_lock held."""
+    if entry.person_key is not None:
+        if _person_komsessions.get(entry.person_key, None) is entry:
+            del _person_komsessions[entry.person_key]
+        entry.person_key = None
+
+def _share_person_komsessions():
+    # The broker knows sessions by connection id, so sharing can't
+    # be done when the sessions are owned by a broker.
+    return app.config['HTTPKOM_SHARE_PERSON_SESSIONS'] and _broker_client is None
+
+def _register_login(connection_id, server, ksession, pers_no, client):
+    """Called after ksession has been successfully logged in as
+    pers_no for connection_id (todo.txt, Förslag B). If there already
+    is a session shared by the person's other connection ids,
+    connection_id is pointed to that session and ksession is closed.
+    Otherwise ksession becomes the person's shared session. Returns
+    the session that connection_id refers to.
+    """
+    key = (server.id, pers_no)
+    to_close = []
+    with _komsessions_lock:
+        current = _komsessions.get(connection_id, None)
+        shared = _person_komsessions.get(key, None)
+        if shared is not None and (shared.ksession is ksession or
+                                   not shared.ksession.is_connected() or
+                                   shared.ksession.get_person_no() != pers_no):
+            _unshare_entry(shared)
+            shared = None
+
+        if shared is None:
+            if current is not None and current.ksession is ksession:
+                entry = current
+            else:
+                entry = _KomSessionEntry(ksession, client)
+            _unshare_entry(entry)
+            entry.person_key = key
+            _person_komsessions[key] = entry
+        else:
+            entry = shared
+            stats.set('sessions.komsessions.shared.last', 1, agg='sum')
+
+        if entry is not current:
+            old_entry = _point_connection_id(connection_id, entry)
+            if old_entry is not None:
+                to_close.append(old_entry.ksession)
+        if entry is shared and ksession not in to_close:
+            # ksession was opened just for this login.
+            to_close.append(ksession)
+    for ks in to_close:
+        _close_komsession(ks)
+    return entry.ksession
+
+def _detach_connection_id(connection_id, server):
+    """Point connection_id to a new, not logged in, session instead of
+    the shared one it refers to now.
+    """
+    with _komsessions_lock:
+        entry = _komsessions[connection_id]
+    client = entry.client or ("httpkom", __version__)
+    ksession = _open_or_reuse_komsession(server, *client)[0]
+    _point_connection_id(connection_id, _KomSessionEntry(ksession, client))
+
+def _is_shared_with_others(entry):
+    with _komsessions_lock:
+        return entry.refcount > 1
+
+def _get_shared_komsession_entry(server):
+    """Return one of the shared sessions for the server, connecting it
+    if needed. The shared sessions are used in turn.
+    """
+    with _shared_komsessions_lock:
+        entries = _shared_komsessions.setdefault(
+            server.id, [ None ] * app.config['HTTPKOM_SHARED_SESSIONS_PER_SERVER'])
+        i = next(_shared_komsessions_counter) % len(entries)
+        entry = entries[i]
+    if entry is not None:
+        return entry
+
+    ksession = _open_komsession(server, "httpkom", __version__)
+    with _shared_komsessions_lock:
+        if entries[i] is None:
+            entries[i] = _KomSessionEntry(ksession)
+            ksession = None
+        entry = entries[i]
+    if ksession is not None:
+        # Another request connected it first.
+        _close_komsession(ksession)
+    return entry
+
+def _forget_shared_komsession_entry(server, entry):
+    with _shared_komsessions_lock:
+        entries = _shared_komsessions.get(server.id, [])
+        for i, e in enumerate(entries):
+            if e is entry:
+                entries[i] = None
+    stats.set('sessions.shared.lost.last', 1, agg='sum')
 
 def _new_connection_id():
     return str(uuid.uuid4())
 
+def _pop_lru_komsessions(max_sessions):
+    """Remove the least recently used connection ids until there are
+    at most max_sessions left. Sessions that are in use by a request
+    are skipped. The lock of each removed entry is held exclusively
+    (see _disconnect_evicted). Must be called with _komsessions_lock
+    held.
+    """
+    evicted = []
+    if max_sessions is not None:
+        for connection_id, entry in list(_komsessions.items()):
+            if len(_komsessions) <= max_sessions:
+                break
+            if entry.lock.try_exclusive():
+                evicted.append((connection_id, _komsessions.pop(connection_id)))
+    return evicted
+
+def _pop_idle_komsessions(idle_timeout, now):
+    """Remove the connection ids that have not been used for
+    idle_timeout seconds, like _pop_lru_komsessions. Must be called
+    with _komsessions_lock held.
+    """
+    evicted = []
+    if idle_timeout is not None:
+        # _komsessions is ordered by when each connection id was used,
+        # but last_used is for the entry, which can be shared by
+        # several connection ids (see _register_login), so all of them
+        # are checked.
+        for connection_id, entry in list(_komsessions.items()):
+            if now - entry.last_used < idle_timeout:
+                continue
+            if entry.lock.try_exclusive():
+                evicted.append((connection_id, _komsessions.pop(connection_id)))
+    return evicted
+
+def _disconnect_evicted(evicted, reason):
+    # The entries are held exclusively, so no request is using them.
+    # Sessions that are still referred to by other connection ids are
+    # kept.
+    for connection_id, entry in evicted:
+        try:
+            with _komsessions_lock:
+                unreferenced = _release_entry(entry)
+            if unreferenced:
+                _close_komsession(entry.ksession)
+        finally:
+            entry.lock.release_exclusive()
+    if evicted:
+        stats.set('sessions.komsessions.evicted.{}.last'.format(reason), len(evicted), agg='sum')
+
+def reap_komsessions():
+    """Disconnect sessions that have been idle for longer than
+    HTTPKOM_SESSION_IDLE_TIMEOUT, and the least recently used
+    sessions if there are more than HTTPKOM_MAX_SESSIONS.
+    """
+    with _komsessions_lock:
+        idle = _pop_idle_komsessions(app.config['HTTPKOM_SESSION_IDLE_TIMEOUT'], time.time())
+        lru = _pop_lru_komsessions(app.config['HTTPKOM_MAX_SESSIONS'])
+    _disconnect_evicted(idle, 'idle')
+    _disconnect_evicted(lru, 'lru')
+
+
+class SessionReaper(threading.Thread):
+    """Background thread that calls reap_komsessions() periodically."""
+    def __init__(self, interval):
+        threading.Thread.__init__(self, name="httpkom-session-reaper")
+        self.daemon = True
+        self._interval = interval
+
+    def run(self):
+        while True:
+            time.sleep(self._interval)
+            try:
+                reap_komsessions()
+            except Exception:
+                app.logger.exception("Failed to reap sessions")
+
+def start_session_reaper():
+    reaper = SessionReaper(app.config['HTTPKOM_SESSION_REAPER_INTERVAL'])
+    reaper.start()
+    return reaper
+
+
+def _lookup_name_with_shared_session(server, name, want_pers, want_confs):
+    entry = _get_shared_komsession_entry(server)
+    with entry.lock.shared():
+        try:
+            return entry.ksession.lookup_name(name, want_pers, want_confs)
+        except (KomSessionNotConnected, socket.error):
+            _forget_shared_komsession_entry(server, entry)
+            raise
+
+def start_name_index_updaters():
+    """Start one thread per server that keeps its name index (see
+    httpkom.nameindex) up to date, if HTTPKOM_NAME_INDEX is set.
+    """
+    updaters = []
+    if app.config['HTTPKOM_NAME_INDEX']:
+        for server in _servers.values():
+            updater = NameIndexUpdater(
+                server, functools.partial(_lookup_name_with_shared_session, server),
+                app.config['HTTPKOM_NAME_INDEX_REFRESH'])
+            updater.start()
+            updaters.append(updater)
+    return updaters
+
 
 
 
@@ -177,6 +620,63 @@ def with_connection_id(f):
     return decorated
 
 
+def _call_with_komsession(entry, f, args, kwargs):
+    """Call the view function f using the session in entry. Returns
+    None if the session's LysKOM connection turns out to be lost.
+    """
+    g.komsession_entry = entry
+    g.ksession = entry.ksession
+    with entry.lock.for_method(request.method):
+        try:
+            return f(*args, **kwargs)
+        except KomSessionNotConnected:
+            return None
+        except socket.error as e:
+            (eno, msg) = e.args
+            if eno in (errno.EPIPE, errno.ECONNRESET):
+                return None
+            else:
+                raise
+
+
+def stream_with_komsession(chunks):
+    """Wrap the iterable chunks for the body of a streamed response.
+    The first chunk is produced right away, by the view function, so
+    errors there give an error response as usual. The rest are
+    produced after the view function has returned, each one holding
+    the session's lock (for reading, so only use it for GET requests),
+    and with the request context.
+    
+    If the session's LysKOM connection is lost, or a LysKOM call
+    fails, after the first chunk, the body ends early. A lost session
+    is removed, as it would have been by the next request.
+    """
+    entry = g.komsession_entry
+    connection_id = g.connection_id
+    server = g.server
+    chunks = iter(chunks)
+    end = object()
+    first = next(chunks, end)
+    def generate():
+        chunk = first
+        while chunk is not end:
+            yield chunk
+            try:
+                with entry.lock.shared():
+                    chunk = next(chunks, end)
+            except (KomSessionNotConnected, socket.error):
+                app.logger.warning("Lost LysKOM connection while streaming a response")
+                if connection_id is not None:
+                    _delete_komsession(connection_id)
+                else:
+                    _forget_shared_komsession_entry(server, entry)
+                return
+            except komerror.Error:
+                app.logger.exception("LysKOM error while streaming a response")
+                return
+    return stream_with_context(generate())
+
+
 def requires_session(f):
     """View function decorator. Check if the request has a
     Httpkom-Connection header that points out a valid LysKOM
@@ -186,21 +686,37 @@ def requires_session(f):
     @functools.wraps(f)
     @with_connection_id
     def decorated(*args, **kwargs):
-        g.ksession = _get_komsession(g.connection_id)
-        if g.ksession is None:
+        entry = _get_komsession_entry(g.connection_id)
+        if entry is None:
             return empty_response(403)
-        try:
-            return f(*args, **kwargs)
-        except KomSessionNotConnected:
+        response = _call_with_komsession(entry, f, args, kwargs)
+        if response is None:
             _delete_komsession(g.connection_id)
             return empty_response(403)
-        except socket.error as e:
-            (eno, msg) = e.args
-            if eno in (errno.EPIPE, errno.ECONNRESET):
-                _delete_komsession(g.connection_id)
-                return empty_response(403)
-            else:
-                raise
+        return response
+    return decorated
+
+
+def allows_shared_session(f):
+    """View function decorator. Same as requires_session, but if the
+    request does not have a Httpkom-Connection, one of the server's
+    shared, not logged in, sessions is used instead. Use it for
+    resources that don't need a logged in session, so anonymous
+    clients don't need a LysKOM connection of their own.
+    """
+    with_own_session = requires_session(f)
+    
+    @functools.wraps(f)
+    @with_connection_id
+    def decorated(*args, **kwargs):
+        if g.connection_id is not None:
+            return with_own_session(*args, **kwargs)
+        entry = _get_shared_komsession_entry(g.server)
+        response = _call_with_komsession(entry, f, args, kwargs)
+        if response is None:
+            _forget_shared_komsession_entry(g.server, entry)
+            return empty_response(503)
+        return response
     return decorated
 
 
@@ -225,12 +741,16 @@ def requires_login(f):
 @requires_session
 def sessions_who_am_i():
     """TODO
+    
+    With the query parameter lookups=none, the person's name is not
+    looked up (see :doc:`intro`).
     """
+    lookups, _ = get_serialization_args(request.args)
     try:
         session_no = g.ksession.who_am_i()
         if g.ksession.is_logged_in():
             pers_no = g.ksession.get_person_no()
-            person = to_dict(KomPerson(pers_no), True, g.ksession)
+            person = to_dict(KomPerson(pers_no), lookups, g.ksession)
         else:
             person = None
 
@@ -314,10 +834,10 @@ def sessions_create():
         # todo: perhaps we should also check if the session is connected?
 
         if not has_existing_ksession:
-            ksession = _open_komsession(
-                g.server.host, g.server.port, client_name, client_version)
-            connection_id = _save_komsession(ksession)
-            response = jsonify(session_no=ksession.who_am_i(), connection_id=connection_id)
+            ksession, session_no = _open_or_reuse_komsession(
+                g.server, client_name, client_version)
+            connection_id = _save_komsession(ksession, (client_name, client_version))
+            response = jsonify(session_no=session_no, connection_id=connection_id)
             response.headers[HTTPKOM_CONNECTION_HEADER] = connection_id
             return response, 201
         else:
@@ -385,12 +905,28 @@ def sessions_login():
     except KeyError as ex:
         return error_response(400, error_msg='Missing "passwd".')
     
+    share = _share_person_komsessions()
+    ksession = g.ksession
+    client = g.komsession_entry.client
+    if share:
+        # Always log in on a new session (todo.txt, Förslag B). The
+        # current session may be shared, or be found as a person's
+        # shared session by other logins while this login changes its
+        # person.
+        ksession = _open_or_reuse_komsession(
+            g.server, *(client or ("httpkom", __version__)))[0]
+    
     try:
-        kom_person = g.ksession.login(pers_no, passwd)
-        return jsonify(to_dict(kom_person, True, g.ksession)), 201
+        kom_person = ksession.login(pers_no, passwd)
     except (komerror.InvalidPassword, komerror.UndefinedPerson, komerror.LoginDisallowed,
             komerror.ConferenceZero) as ex:
+        if ksession is not g.ksession:
+            _close_komsession(ksession)
         return error_response(401, kom_error=ex)
+    
+    if share:
+        ksession = _register_login(g.connection_id, g.server, ksession, kom_person.pers_no, client)
+    return jsonify(to_dict(kom_person, True, ksession)), 201
 
 
 @bp.route("/sessions/current/logout", methods=['POST'])
@@ -418,9 +954,17 @@ def sessions_logout():
       curl -v -H "Httpkom-Connection: 033556ee-3e52-423f-9c9a-d85aed7688a1" \\
            -X POST "http://localhost:5001/lyskom/sessions/current/logout"
     
+    If the session is shared with other connection ids logged in as
+    the same person, only this connection id is logged out.
+    
     """
-
+    if _share_person_komsessions() and _is_shared_with_others(g.komsession_entry):
+        _detach_connection_id(g.connection_id, g.server)
+        return empty_response(204)
+    
     g.ksession.logout()
+    with _komsessions_lock:
+        _unshare_entry(g.komsession_entry)
     return empty_response(204)
 
 
@@ -464,6 +1008,12 @@ def sessions_delete(session_no):
            -X DELETE "http://localhost:5001/lyskom/sessions/abc123"
     
     """
+    if _is_shared_with_others(g.komsession_entry) and session_no in (0, g.ksession.who_am_i()):
+        # Other connection ids use the LysKOM session, so only forget
+        # this connection id.
+        _delete_komsession(g.connection_id)
+        return empty_response(204)
+    
     try:
         g.ksession.disconnect(session_no)
         # We should delete the connection if we're no longer connected
@@ -1,11 +1,12 @@
 import time
 import threading
 
-from flask import g, jsonify
+from flask import g
 from pylyskom.stats import Stats
 from pylyskom.stats import stats as pylyskom_stats
 
 from httpkom import app
+from .jsonresponse import jsonify
 
 
 stats = Stats(prefix='httpkom.')
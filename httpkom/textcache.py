@@ -0,0 +1,176 @@
+# -*- coding: utf-8 -*-
+# Copyright (C) 2012 Oskar Skoog. Released under GPL.
+
+"""Text cache shared by all sessions to a LysKOM server.
+
+Only the contents (subject, body and content type) of texts are
+shared, and only for texts where all recipients are open conferences
+(not read protected and not secret). The contents of a text never
+change.
+
+The text stat is always the session's own, so the comment and
+recipient lists are the ones the person is allowed to see, and
+getting it checks that the person can read the text. A text is
+removed from the cache when it is deleted or its recipients change.
+"""
+
+from __future__ import absolute_import
+import collections
+import threading
+
+import pylyskom.errors as komerror
+from pylyskom.asyncmsg import AsyncMessages
+from pylyskom.komsession import KomText
+
+from httpkom import app
+from .pipelining import fetch_texts, pipelined_client, prefetch
+from .stats import stats
+
+
+# Rough size in bytes of a cached text, in addition to the body.
+_ENTRY_OVERHEAD = 300
+
+
+class _CachedText(object):
+    def __init__(self, komtext):
+        self.subject = komtext.subject
+        self.body = komtext.body
+        self.content_type = komtext.content_type
+        self.size = _ENTRY_OVERHEAD + (len(self.body) if self.body is not None else 0)
+
+    def komtext(self, text_no, text_stat):
+        komtext = KomText(text_no=text_no, text=None, text_stat=text_stat)
+        komtext.subject = self.subject
+        komtext.body = self.body
+        komtext.content_type = self.content_type
+        return komtext
+
+
+class TextCache(object):
+    """LRU cache of the contents of public texts, with a memory
+    budget.
+    """
+    def __init__(self, stats_prefix, max_bytes):
+        self._stats_prefix = stats_prefix
+        self._max_bytes = max_bytes
+        # text_no -> _CachedText, least recently used first
+        self._texts = collections.OrderedDict()
+        self._size = 0
+        self._lock = threading.Lock()
+
+    def get(self, text_no):
+        """Return the cached _CachedText, or None."""
+        with self._lock:
+            cached = self._texts.pop(text_no, None)
+            if cached is not None:
+                self._texts[text_no] = cached
+        stats.set(self._stats_prefix + ('hits.last' if cached is not None else 'misses.last'),
+                  1, agg='sum')
+        return cached
+
+    def set(self, komtext):
+        cached = _CachedText(komtext)
+        with self._lock:
+            self._remove(komtext.text_no)
+            self._texts[komtext.text_no] = cached
+            self._size += cached.size
+            while self._size > self._max_bytes and self._texts:
+                self._remove(next(iter(self._texts)))
+            stats.set(self._stats_prefix + 'bytes.last', self._size, agg='last')
+
+    def remove(self, text_no):
+        with self._lock:
+            self._remove(text_no)
+
+    def _remove(self, text_no):
+        cached = self._texts.pop(text_no, None)
+        if cached is not None:
+            self._size -= cached.size
+
+
+_text_caches = {}
+_text_caches_lock = threading.Lock()
+
+def get_text_cache(server):
+    with _text_caches_lock:
+        if server.id not in _text_caches:
+            _text_caches[server.id] = TextCache(
+                'textcache.{}.'.format(server.id),
+                app.config['HTTPKOM_TEXT_CACHE_MAX_BYTES'])
+        return _text_caches[server.id]
+
+
+def _is_public(ksession, komtext):
+    if not komtext.recipient_list:
+        return False
+    prefetch(ksession, conf_nos=[ mir.recpt for mir in komtext.recipient_list ])
+    for mir in komtext.recipient_list:
+        try:
+            conf_type = ksession.get_conference(mir.recpt, True).type
+        except komerror.ServerError:
+            return False
+        if conf_type.rd_prot or conf_type.secret:
+            return False
+    return True
+
+def get_text(ksession, server, text_no):
+    """Get a text using the server's shared cache if possible."""
+    if app.config['HTTPKOM_TEXT_CACHE_MAX_BYTES'] <= 0:
+        return ksession.get_text(text_no)
+
+    cache = get_text_cache(server)
+    cached = cache.get(text_no)
+    if cached is not None:
+        return cached.komtext(text_no, ksession.get_text_stat(text_no))
+    komtext = ksession.get_text(text_no)
+    if _is_public(ksession, komtext):
+        cache.set(komtext)
+    return komtext
+
+def get_texts(ksession, server, text_nos,
+              ignored_errors=(komerror.NoSuchText, komerror.TextZero)):
+    """Get several texts, using the server's shared cache if possible
+    and fetching the rest in one pipelined batch (see
+    httpkom.pipelining.fetch_texts).
+    """
+    if app.config['HTTPKOM_TEXT_CACHE_MAX_BYTES'] <= 0:
+        return fetch_texts(ksession, text_nos, ignored_errors)
+
+    cache = get_text_cache(server)
+    cached = {}
+    for text_no in text_nos:
+        c = cache.get(text_no)
+        if c is not None:
+            cached[text_no] = c
+    result = fetch_texts(ksession, [ no for no in text_nos if no not in cached ], ignored_errors)
+    komtexts = [ t for t in result.values() if isinstance(t, KomText) ]
+
+    prefetch(ksession, text_nos=cached.keys(),
+             conf_nos=[ mir.recpt for t in komtexts for mir in t.recipient_list or [] ],
+             author_conf_nos=False)
+    for text_no, c in cached.items():
+        try:
+            result[text_no] = c.komtext(text_no, ksession.get_text_stat(text_no))
+        except ignored_errors as ex:
+            result[text_no] = ex
+    for komtext in komtexts:
+        if _is_public(ksession, komtext):
+            cache.set(komtext)
+    return result
+
+
+def attach_text_cache(ksession, server):
+    """Let the session's async messages remove texts from the server's
+    shared text cache. Does nothing for sessions that are not owned by
+    this process.
+    """
+    client = pipelined_client(ksession)
+    if client is None:
+        return
+
+    cache = get_text_cache(server)
+    def text_handler(msg):
+        cache.remove(msg.text_no)
+    client.register_async_handler(AsyncMessages.DELETED_TEXT, text_handler, skip_accept_async=True)
+    client.register_async_handler(AsyncMessages.NEW_RECIPIENT, text_handler, skip_accept_async=True)
+    client.register_async_handler(AsyncMessages.SUB_RECIPIENT, text_handler)
@@ -0,0 +1,209 @@
+# -*- coding: utf-8 -*-
+# Copyright (C) 2012 Oskar Skoog. Released under GPL.
+
+"""Maps from local to global text numbers, for paging through the
+texts of a conference.
+
+Protocol A's local-to-global returns at most 255 texts per call, so a
+TextMap covers a contiguous range of local numbers that is extended
+downwards (older texts) with several calls sent at once, and upwards
+when the conference gets new texts. Paging back through a conference
+then only asks the LysKOM server about the part that has not been
+seen before.
+
+The maps are kept per session, since which texts a person can see
+depends on the person, for at most _MAX_AGE seconds (texts can be
+added to and removed from a conference in other ways than by being
+created).
+"""
+
+from __future__ import absolute_import
+import bisect
+import collections
+import threading
+import time
+import weakref
+
+import pylyskom.errors as komerror
+from pylyskom import requests
+
+from .pipelining import pipelined_client
+
+
+# Max texts per local-to-global call (Protocol A limit).
+_CALL_SIZE = 255
+# Number of local-to-global calls sent at once when extending a map.
+_CALLS_PER_EXTENSION = 8
+# Maps per session, least recently used are dropped.
+_MAX_MAPS_PER_SESSION = 10
+_MAX_AGE = 10 * 60
+
+# ksession -> OrderedDict(conf_no -> TextMap)
+_text_maps = weakref.WeakKeyDictionary()
+_text_maps_lock = threading.Lock()
+
+
+class TextMap(object):
+    """Local to global text numbers of a conference, for the local
+    numbers from low to high (inclusive).
+    """
+    def __init__(self, conf_no, first_local_no):
+        self.conf_no = conf_no
+        self.created = time.time()
+        self.first_local_no = first_local_no
+        # Sorted local numbers of existing texts, and their global numbers
+        self._local_nos = []
+        self._texts = {}
+        self.low = None
+        self.high = None
+        self.lock = threading.Lock()
+
+    def _add(self, local_no, text_no):
+        if local_no not in self._texts:
+            bisect.insort(self._local_nos, local_no)
+        self._texts[local_no] = text_no
+
+    def _fetch(self, client, first_local_nos):
+        pending = [ client.send(requests.ReqLocalToGlobal(self.conf_no, first, _CALL_SIZE))
+                    for first in first_local_nos ]
+        mappings = []
+        for ref_no in pending:
+            try:
+                mappings.append(client.response(ref_no))
+            except komerror.NoSuchLocalText:
+                # After the highest local number of the conference.
+                pass
+        for mapping in mappings:
+            for local_no, text_no in mapping.list:
+                if text_no != 0:
+                    self._add(local_no, text_no)
+        return mappings
+
+    def extend_down(self, client, to_local_no):
+        """Cover the local numbers down to to_local_no (or the first
+        local number of the conference).
+        """
+        to_local_no = max(to_local_no, self.first_local_no)
+        while self.low > to_local_no:
+            firsts = sorted(set(max(self.low - _CALL_SIZE * i, self.first_local_no)
+                                for i in range(1, _CALLS_PER_EXTENSION + 1)))
+            self._fetch(client, firsts)
+            # Each call covers at least _CALL_SIZE local numbers.
+            self.low = firsts[0]
+
+    def extend_up(self, client, to_local_no):
+        """Cover the local numbers up to to_local_no, or up to the
+        highest local number of the conference if that is lower.
+        """
+        while self.high < to_local_no:
+            firsts = [ self.high + 1 + _CALL_SIZE * i for i in range(_CALLS_PER_EXTENSION)
+                       if self.high + 1 + _CALL_SIZE * i <= to_local_no ]
+            mappings = self._fetch(client, firsts)
+            high = max([ self.high ] + [ m.range_end - 1 for m in mappings ])
+            if high == self.high:
+                break
+            self.high = high
+
+    def reset(self, high):
+        """Forget everything, and start covering from high and down."""
+        self._local_nos = []
+        self._texts = {}
+        self.high = high
+        self.low = high + 1
+
+    def before(self, local_no, count):
+        """Up to count (local_no, text_no) before local_no, newest first."""
+        i = bisect.bisect_left(self._local_nos, local_no)
+        local_nos = self._local_nos[max(i - count, 0):i]
+        return [ (no, self._texts[no]) for no in reversed(local_nos) ]
+
+    def after(self, local_no, count):
+        """Up to count (local_no, text_no) after local_no, oldest first."""
+        i = bisect.bisect_right(self._local_nos, local_no)
+        return [ (no, self._texts[no]) for no in self._local_nos[i:i + count] ]
+
+    def remove(self, local_no):
+        if self._texts.pop(local_no, None) is not None:
+            self._local_nos.remove(local_no)
+
+
+def _get_text_map(ksession, conf_no, first_local_no):
+    with _text_maps_lock:
+        maps = _text_maps.setdefault(ksession, collections.OrderedDict())
+        text_map = maps.pop(conf_no, None)
+        if (text_map is None or time.time() - text_map.created > _MAX_AGE or
+            text_map.first_local_no != first_local_no):
+            text_map = TextMap(conf_no, first_local_no)
+        maps[conf_no] = text_map
+        while len(maps) > _MAX_MAPS_PER_SESSION:
+            maps.popitem(last=False)
+        return text_map
+
+
+def is_supported(ksession):
+    """Text maps can only be used with sessions owned by this process."""
+    return pipelined_client(ksession) is not None
+
+
+def get_page(ksession, conf_no, count, before=None, after=None):
+    """Return up to count (local_no, text_no) in conf_no before the
+    local number before (newest first), or after the local number
+    after (oldest first). If neither is given, the last texts in the
+    conference are returned, oldest first (like
+    KomSession.get_last_texts). Also returns whether there are more
+    texts in the same direction (older texts, if neither is given).
+    """
+    client = pipelined_client(ksession)
+    if client is not None:
+        # New texts invalidate the cached conference through async
+        # messages.
+        client.handle_async_messages()
+    conf = ksession.get_conference(conf_no, False)
+    first_local_no = conf.first_local_no
+    highest_local_no = first_local_no + conf.no_of_texts - 1
+
+    # Jumping further than this resets the map instead of extending it.
+    max_jump = _CALL_SIZE * _CALLS_PER_EXTENSION
+
+    text_map = _get_text_map(ksession, conf_no, first_local_no)
+    with text_map.lock:
+        if after is None:
+            last_texts = before is None
+            if last_texts or before > highest_local_no + 1:
+                before = highest_local_no + 1
+            if text_map.low is None or not text_map.low - max_jump <= before <= text_map.high + 1 + max_jump:
+                text_map.reset(before - 1)
+            text_map.extend_up(client, before - 1)
+            page = text_map.before(before, count)
+            while len(page) < count and text_map.low > first_local_no:
+                text_map.extend_down(client, text_map.low - 1)
+                page = text_map.before(before, count)
+            lowest = page[-1][0] if page else before
+            has_more = bool(text_map.before(lowest, 1)) or text_map.low > first_local_no
+            if last_texts:
+                page.reverse()
+        else:
+            after = max(after, first_local_no - 1)
+            if text_map.low is None or not text_map.low - 1 - max_jump <= after <= text_map.high + max_jump:
+                text_map.reset(after)
+            text_map.extend_down(client, after + 1)
+            page = text_map.after(after, count)
+            while len(page) < count and text_map.high < highest_local_no:
+                high = text_map.high
+                text_map.extend_up(client, min(text_map.high + max_jump, highest_local_no))
+                if text_map.high == high:
+                    # highest_local_no was outdated.
+                    break
+                page = text_map.after(after, count)
+            highest = page[-1][0] if page else after
+            has_more = bool(text_map.after(highest, 1)) or text_map.high < highest_local_no
+    return page, has_more
+
+
+def forget_text(ksession, conf_no, local_no):
+    """Remove a text that turned out not to exist from the map."""
+    with _text_maps_lock:
+        text_map = _text_maps.get(ksession, {}).get(conf_no, None)
+    if text_map is not None:
+        with text_map.lock:
+            text_map.remove(local_no)
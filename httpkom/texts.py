@@ -5,17 +5,52 @@ from __future__ import absolute_import
 
 from io import BytesIO
 
-from flask import g, request, jsonify, send_file, url_for
+from flask import g, request, send_file, url_for
+from six.moves import range
 
 import pylyskom.errors as komerror
 from pylyskom.utils import parse_content_type
 
-from .komserialization import to_dict
+from .komserialization import MICommentIn_type_to_str, to_dict, to_dict_chunks
 
 from httpkom import bp
-from .errors import error_response
-from .misc import empty_response
-from .sessions import requires_login
+from .errors import error_response, kom_error_to_dict
+from .jsonresponse import jsonify, stream_jsonify
+from .misc import (empty_response, get_serialization_args, make_etag, is_not_modified,
+                   not_modified_response)
+from .pipelining import mark_as_read
+from .sessions import requires_login, stream_with_komsession
+from .textcache import get_text, get_texts
+from .unreads import invalidate_unreads, unreads_text_read
+
+
+# Bodies never change, so they can be cached by the client.
+_BODY_MAX_AGE = 365 * 24 * 60 * 60
+
+# Max number of texts in one request to texts_list / texts_list_post.
+_MAX_TEXTS_PER_REQUEST = 200
+
+# Limits and defaults for texts_get_tree.
+_TREE_DEFAULT_DEPTH = 10
+_TREE_MAX_DEPTH = 50
+_TREE_DEFAULT_MAX_NODES = 100
+_TREE_MAX_MAX_NODES = 500
+
+# Max number of texts (global and local) in one request to
+# texts_put_read_markings.
+_MAX_READ_MARKINGS_PER_REQUEST = 5000
+
+
+def _text_stat_etag(komtext):
+    """Weak entity tag for a text, computed from the parts of the text
+    stat that can change.
+    """
+    return make_etag(
+        komtext.text_no, komtext.no_of_marks,
+        [ (r.type, r.recpt, r.loc_no) for r in komtext.recipient_list or [] ],
+        [ (c.type, c.text_no) for c in komtext.comment_to_list or [] ],
+        [ (c.type, c.text_no) for c in komtext.comment_in_list or [] ],
+        [ (a.aux_no, a.flags.deleted) for a in komtext.aux_items or [] ])
 
 
 @bp.route('/texts/<int:text_no>')
@@ -25,6 +60,16 @@ def texts_get(text_no):
     
     Note: The body will only be included in the response if the content type is text.
     
+    Query parameters:
+    
+    =======  =======  =================================================================
+    Key      Type     Values
+    =======  =======  =================================================================
+    fields   string   Comma separated list of fields to include (see :doc:`intro`).
+                      Default: all
+    lookups  string   ``none``, ``names`` or ``full`` (see :doc:`intro`). Default: ``full``
+    =======  =======  =================================================================
+    
     .. rubric:: Request
     
     ::
@@ -65,20 +110,288 @@ def texts_get(text_no):
       
       { TODO: error stuff }
     
+    The response has a (weak) ETag, and a request with a matching
+    If-None-Match gets the response ``304 Not Modified``.
+    
     .. rubric:: Example
     
     ::
     
       curl -v -X GET -H "Content-Type: application/json" \\
            "http://localhost:5001/lyskom/texts/19680717"
+      
+      curl -v -X GET -H "Content-Type: application/json" \\
+           "http://localhost:5001/lyskom/texts/19680717?fields=text_no,subject,author&lookups=none"
     
     """
+    lookups, fields = get_serialization_args(request.args)
     try:
-        return jsonify(to_dict(g.ksession.get_text(text_no), True, g.ksession))
+        komtext = get_text(g.ksession, g.server, text_no)
+        etag = _text_stat_etag(komtext)
+        if is_not_modified(etag):
+            return not_modified_response(etag, weak=True)
+        
+        response = jsonify(to_dict(komtext, lookups, g.ksession, fields))
+        response.set_etag(etag, weak=True)
+        return response
     except komerror.NoSuchText as ex:
         return error_response(404, kom_error=ex)
 
 
+def _texts_response(text_nos):
+    lookups, fields = get_serialization_args(request.args)
+    if len(text_nos) > _MAX_TEXTS_PER_REQUEST:
+        return error_response(400, error_msg='Too many texts (max {}).'.format(
+                _MAX_TEXTS_PER_REQUEST))
+    
+    # Errors are returned per text, so one bad text does not fail the
+    # others.
+    texts = get_texts(g.ksession, g.server, list(set(text_nos)),
+                      ignored_errors=komerror.ServerError)
+    komtexts = [ texts[no] for no in text_nos if not isinstance(texts[no], komerror.Error) ]
+    # Serialize all texts at once, so the lookups are shared.
+    text_dicts = iter(to_dict(komtexts, lookups, g.ksession, fields))
+    result = []
+    for no in text_nos:
+        if isinstance(texts[no], komerror.Error):
+            result.append(dict(text_no=no, error=kom_error_to_dict(texts[no])))
+        else:
+            result.append(next(text_dicts))
+    return jsonify(texts=result)
+
+
+@bp.route('/texts/')
+@requires_login
+def texts_list():
+    """Get several texts at once. The texts are fetched from the LysKOM
+    server in one pipelined batch. Each text has the same format as in
+    texts_get. Texts that do not exist are returned as errors, in the
+    same position in the list.
+    
+    Query parameters:
+    
+    =======  =======  =================================================================
+    Key      Type     Values
+    =======  =======  =================================================================
+    text_no  string   Comma separated list of text numbers (at most 200).
+    fields   string   Comma separated list of fields to include in each text (see
+                      :doc:`intro`). Default: all
+    lookups  string   ``none``, ``names`` or ``full`` (see :doc:`intro`). Default: ``full``
+    =======  =======  =================================================================
+    
+    .. rubric:: Request
+    
+    ::
+    
+      GET /<server_id>/texts/?text_no=19680717,4711 HTTP/1.0
+    
+    .. rubric:: Response
+    
+    ::
+    
+      HTTP/1.0 200 OK
+      
+      {
+        "texts": [
+          {
+            "text_no": 19680717,
+            "subject": "jaha",
+            ...
+          },
+          {
+            "text_no": 4711,
+            "error": {
+              "error_code": 14,
+              "error_status": "4711",
+              "error_type": "protocol-a",
+              "error_msg": "NoSuchText"
+            }
+          }
+        ]
+      }
+    
+    .. rubric:: Example
+    
+    ::
+    
+      curl -v -X GET -H "Content-Type: application/json" \\
+           "http://localhost:5001/lyskom/texts/?text_no=19680717,4711"
+    
+    """
+    try:
+        text_nos = [ int(no) for no in request.args['text_no'].split(',') if no.strip() ]
+    except KeyError:
+        return error_response(400, error_msg='Missing "text_no".')
+    except ValueError:
+        return error_response(400, error_msg='Invalid "text_no".')
+    return _texts_response(text_nos)
+
+
+@bp.route('/texts/bulk', methods=['POST'])
+@requires_login
+def texts_list_post():
+    """Same as texts_list, but with the text numbers in the body, for
+    lists that are too long for a URL. Does not change anything. The
+    "fields" and "lookups" query parameters work as in texts_list.
+    
+    .. rubric:: Request
+    
+    ::
+    
+      POST /<server_id>/texts/bulk HTTP/1.0
+      
+      {
+        "text_nos": [ 19680717, 4711 ]
+      }
+    
+    .. rubric:: Response
+    
+    Same as for texts_list.
+    
+    .. rubric:: Example
+    
+    ::
+    
+      curl -v -X POST -H "Content-Type: application/json" \\
+           -d '{ "text_nos": [ 19680717, 4711 ] }' \\
+           "http://localhost:5001/lyskom/texts/bulk"
+    
+    """
+    try:
+        text_nos = [ int(no) for no in request.json['text_nos'] ]
+    except KeyError:
+        return error_response(400, error_msg='Missing "text_nos".')
+    except (TypeError, ValueError):
+        return error_response(400, error_msg='Invalid "text_nos".')
+    return _texts_response(text_nos)
+
+
+@bp.route('/texts/<int:text_no>/tree')
+@requires_login
+def texts_get_tree(text_no):
+    """Get a text and the tree of comments (and footnotes) to it. The
+    tree is expanded one level at a time, and each level is fetched
+    from the LysKOM server in one pipelined batch.
+    
+    The texts are returned as a flat list of nodes (each with the same
+    format as in texts_get), in breadth first order, together with the
+    parent/child edges between them. Comments that can not be read
+    are left out.
+    
+    Query parameters:
+    
+    =========  =======  =================================================================
+    Key        Type     Values
+    =========  =======  =================================================================
+    depth      integer  Number of comment levels below the text to include, at most 50.
+                        Default: 10
+    max-nodes  integer  Max number of texts to include, at most 500. Default: 100
+    fields     string   Comma separated list of fields to include in each node (see
+                        :doc:`intro`). Default: all
+    lookups    string   ``none``, ``names`` or ``full`` (see :doc:`intro`). Default: ``full``
+    =========  =======  =================================================================
+    
+    "truncated" is true if there were more comments than the limits
+    allowed.
+    
+    .. rubric:: Request
+    
+    ::
+    
+      GET /<server_id>/texts/19680717/tree?depth=2 HTTP/1.0
+    
+    .. rubric:: Responses
+    
+    Text exists::
+    
+      HTTP/1.0 200 OK
+      
+      {
+        "root": 19680717,
+        "nodes": [
+          { "text_no": 19680717, "subject": "jaha", ... },
+          { "text_no": 19680720, "subject": "jaha", ... }
+        ],
+        "edges": [
+          { "parent": 19680717, "child": 19680720, "type": "comment" }
+        ],
+        "truncated": false
+      }
+    
+    Text does not exist::
+    
+      HTTP/1.0 404 NOT FOUND
+    
+    .. rubric:: Example
+    
+    ::
+    
+      curl -v -X GET -H "Content-Type: application/json" \\
+           "http://localhost:5001/lyskom/texts/19680717/tree?depth=2&max-nodes=50"
+    
+    """
+    try:
+        depth = int(request.args.get('depth', _TREE_DEFAULT_DEPTH))
+        max_nodes = int(request.args.get('max-nodes', _TREE_DEFAULT_MAX_NODES))
+    except ValueError:
+        return error_response(400, error_msg='Invalid "depth" or "max-nodes".')
+    if not 0 <= depth <= _TREE_MAX_DEPTH or not 0 < max_nodes <= _TREE_MAX_MAX_NODES:
+        return error_response(400, error_msg='"depth" or "max-nodes" out of range.')
+    lookups, fields = get_serialization_args(request.args)
+    
+    try:
+        root = get_text(g.ksession, g.server, text_no)
+    except komerror.NoSuchText as ex:
+        return error_response(404, kom_error=ex)
+    
+    komtexts = [ root ]
+    visited = set([ text_no ])
+    edges = []
+    truncated = False
+    level = [ root ]
+    for _ in range(depth):
+        children = []
+        for parent in level:
+            for c in parent.comment_in_list or []:
+                if c.text_no not in visited:
+                    visited.add(c.text_no)
+                    children.append((parent.text_no, c))
+        if len(komtexts) + len(children) > max_nodes:
+            children = children[:max_nodes - len(komtexts)]
+            truncated = True
+        if not children:
+            break
+        
+        fetched = get_texts(g.ksession, g.server, [ c.text_no for parent_no, c in children ])
+        level = []
+        for parent_no, c in children:
+            komtext = fetched[c.text_no]
+            if isinstance(komtext, komerror.Error):
+                continue
+            level.append(komtext)
+            edges.append(dict(parent=parent_no, child=c.text_no,
+                              type=MICommentIn_type_to_str[c.type]))
+        komtexts.extend(level)
+        if truncated:
+            break
+    else:
+        truncated = any(komtext.comment_in_list for komtext in level)
+    
+    # Serialize all nodes at once, so the lookups are shared.
+    return jsonify(root=text_no, nodes=to_dict(komtexts, lookups, g.ksession, fields),
+                   edges=edges, truncated=truncated)
+
+
+def _cache_body(response):
+    # send_file makes the body public and sets Expires. Reading a
+    # body requires a session, so only the client may cache it.
+    response.cache_control.public = False
+    response.cache_control.private = True
+    response.cache_control.max_age = _BODY_MAX_AGE
+    del response.headers['Expires']
+    return response
+
+
 @bp.route('/texts/<int:text_no>/body')
 @requires_login
 def texts_get_body(text_no):
@@ -88,6 +401,11 @@ def texts_get_body(text_no):
     If the content type is text, the text will be recoded to UTF-8. For other types,
     the content type will be left untouched.
     
+    The body of a text never changes, so the response has an ETag
+    (strong, or weak if the response is compressed) and may be cached
+    by the client. A request with a matching If-None-Match gets the
+    response ``304 Not Modified``.
+    
     .. rubric:: Request
     
     ::
@@ -118,7 +436,13 @@ def texts_get_body(text_no):
     
     """
     try:
-        text = g.ksession.get_text(text_no)
+        etag = make_etag(g.server.id, text_no)
+        if is_not_modified(etag):
+            # Make sure that the text still exists (and can be read).
+            g.ksession.get_text_stat(text_no)
+            return _cache_body(not_modified_response(etag))
+        
+        text = get_text(g.ksession, g.server, text_no)
         mime_type, encoding = parse_content_type(text.content_type)
         
         if mime_type[0] == 'text':
@@ -128,8 +452,8 @@ def texts_get_body(text_no):
         response = send_file(data,
                              mimetype=text.content_type,
                              as_attachment=False)
-            
-        return response
+        response.set_etag(etag)
+        return _cache_body(response)
     except komerror.NoSuchText as ex:
         return error_response(404, kom_error=ex)
 
@@ -209,6 +533,10 @@ def texts_create():
 def texts_get_marks():
     """Get the list of marked texts.
     
+    The list is streamed: it is serialized and sent a part at a time.
+    With ``Accept: application/x-ndjson``, the marks are sent as
+    NDJSON, one per line (see :doc:`intro`).
+    
     .. rubric:: Request
     
     ::
@@ -236,7 +564,9 @@ def texts_get_marks():
            "http://localhost:5001/lyskom/texts/marks/"
     
     """
-    return jsonify(dict(marks=to_dict(g.ksession.get_marks(), True, g.ksession)))
+    lookups, fields = get_serialization_args(request.args)
+    chunks = to_dict_chunks(g.ksession.get_marks(), lookups, g.ksession, fields)
+    return stream_jsonify('marks', stream_with_komsession(chunks))
 
 
 @bp.route('/texts/<int:text_no>/mark', methods=['PUT'])
@@ -337,6 +667,7 @@ def texts_put_read_marking(text_no):
     
     """
     g.ksession.mark_as_read(text_no)
+    unreads_text_read(g.ksession, text_no)
     return empty_response(201)
 
 
@@ -365,4 +696,94 @@ def texts_delete_read_marking(text_no):
     
     """
     g.ksession.mark_as_unread(text_no)
+    invalidate_unreads(g.ksession)
     return empty_response(204)
+
+
+@bp.route('/texts/read-markings', methods=['POST'])
+@requires_login
+def texts_put_read_markings():
+    """Mark several texts as read. Texts given by global text number
+    are marked as read in all recipient conferences. Ranges of local
+    text numbers are marked as read in the given conference (only).
+    The calls to the LysKOM server are batched, with one call per
+    conference.
+    
+    The result for each text number and range is returned in the same
+    order as in the request, with an error object for the ones that
+    failed.
+    
+    .. rubric:: Request
+    
+    ::
+    
+      POST /<server_id>/texts/read-markings HTTP/1.0
+      
+      {
+        "text_nos": [ 19680717, 4711 ],
+        "local_texts": [
+          { "conf_no": 14506, "first_local_no": 29, "last_local_no": 40 }
+        ]
+      }
+    
+    .. rubric:: Responses
+    
+    ::
+    
+      HTTP/1.0 200 OK
+      
+      {
+        "text_nos": [
+          { "text_no": 19680717 },
+          { "text_no": 4711, "error": { "error_code": 14, ... } }
+        ],
+        "local_texts": [
+          { "conf_no": 14506, "first_local_no": 29, "last_local_no": 40 }
+        ]
+      }
+    
+    .. rubric:: Example
+    
+    ::
+    
+      curl -v -X POST -H "Content-Type: application/json" \\
+           -d '{ "text_nos": [ 19680717, 4711 ] }' \\
+           "http://localhost:5001/lyskom/texts/read-markings"
+    
+    """
+    if not isinstance(request.json, dict):
+        return error_response(400, error_msg='Invalid body.')
+    try:
+        text_nos = [ int(no) for no in request.json.get('text_nos', []) ]
+        local_ranges = [ (int(r['conf_no']), int(r['first_local_no']), int(r['last_local_no']))
+                         for r in request.json.get('local_texts', []) ]
+    except KeyError as ex:
+        return error_response(400, error_msg='Missing "{}" in "local_texts".'.format(ex.args[0]))
+    except (TypeError, ValueError):
+        return error_response(400, error_msg='Invalid "text_nos" or "local_texts".')
+    
+    if any(last < first for conf_no, first, last in local_ranges):
+        return error_response(400, error_msg='"last_local_no" is less than "first_local_no".')
+    if len(text_nos) + sum(last - first + 1 for conf_no, first, last in local_ranges) > \
+            _MAX_READ_MARKINGS_PER_REQUEST:
+        return error_response(400, error_msg='Too many texts (max {}).'.format(
+                _MAX_READ_MARKINGS_PER_REQUEST))
+    
+    local_text_nos = [ (conf_no, range(first, last + 1)) for conf_no, first, last in local_ranges ]
+    text_errors, local_errors = mark_as_read(g.ksession, text_nos, local_text_nos)
+    
+    text_results = []
+    for no in text_nos:
+        if text_errors[no] is None:
+            unreads_text_read(g.ksession, no)
+            text_results.append(dict(text_no=no))
+        else:
+            text_results.append(dict(text_no=no, error=kom_error_to_dict(text_errors[no])))
+    local_results = []
+    for (conf_no, first, last), error in zip(local_ranges, local_errors):
+        invalidate_unreads(g.ksession, conf_no)
+        result = dict(conf_no=conf_no, first_local_no=first, last_local_no=last)
+        if error is not None:
+            result['error'] = kom_error_to_dict(error)
+        local_results.append(result)
+    return jsonify(text_nos=text_results, local_texts=local_results)
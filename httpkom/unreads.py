@@ -0,0 +1,230 @@
+# -*- coding: utf-8 -*-
+# Copyright (C) 2012 Oskar Skoog. Released under GPL.
+
+"""Unread texts kept up to date by httpkom.
+
+Asking the LysKOM server for a person's unread texts means a call per
+membership, and clients poll for them often. An UnreadTracker fetches
+them once and then keeps them up to date with the session's async
+messages (new-text, deleted-text, new-recipient and sub-recipient)
+and the read markings done through httpkom.
+
+Read markings done by the person's other sessions are not reported
+by the LysKOM server, so everything is fetched again when it is older
+than HTTPKOM_UNREAD_RESYNC_INTERVAL seconds. Changes that are hard to
+follow (a text marked as read with its local number, a text marked as
+unread) make the tracker fetch the affected membership, or everything,
+again the next time it is used.
+"""
+
+from __future__ import absolute_import
+import threading
+import time
+
+from pylyskom.asyncmsg import AsyncMessages
+from pylyskom.komsession import KomMembershipUnread
+
+from httpkom import app
+from .pipelining import pipelined_client
+from .stats import stats
+
+
+# Max number of memberships fetched when syncing.
+_MAX_MEMBERSHIPS = 10000
+
+
+class UnreadTracker(object):
+    """Unread texts for the person logged in on a session.
+    
+    The LysKOM calls are made without holding _lock, since the async
+    message handlers (that need _lock) are called by whichever thread
+    is reading from the connection. Changes made while syncing are
+    recorded and applied again on top of the fetched state.
+    """
+    def __init__(self, resync_interval):
+        self._resync_interval = resync_interval
+        self._lock = threading.Lock()
+        self._sync_lock = threading.Lock()
+        # Changes during a sync, as (method, args)
+        self._changes = None
+        self._set_state(None, {}, {})
+        self._synced_at = None
+
+    def _set_state(self, pers_no, memberships, unreads):
+        self._pers_no = pers_no
+        # Active memberships by conf_no
+        self._memberships = memberships
+        # conf_no -> set of unread global text numbers
+        self._unreads = unreads
+        # Memberships that must be fetched again before they are used
+        self._stale_confs = set()
+
+    def _change(self, method, *args):
+        with self._lock:
+            if self._changes is not None:
+                self._changes.append((method, args))
+            method(*args)
+
+    def _sync(self, ksession, pers_no):
+        with self._sync_lock:
+            with self._lock:
+                full = (self._pers_no != pers_no or self._synced_at is None or
+                        time.time() - self._synced_at >= self._resync_interval)
+                stale_confs = list(self._stale_confs)
+                if not full and not stale_confs:
+                    return
+                self._changes = []
+
+            try:
+                if full:
+                    memberships, has_more = ksession.get_memberships(
+                        pers_no, 0, _MAX_MEMBERSHIPS, False, False)
+                    unreads = dict((mu.conf_no, set(mu.unread_texts))
+                                   for mu in ksession.get_membership_unreads(pers_no))
+                    stats.set('unreads.syncs.last', 1, agg='sum')
+                else:
+                    unreads = dict((conf_no, set(ksession.get_membership_unread(
+                                        pers_no, conf_no).unread_texts))
+                                   for conf_no in stale_confs)
+            finally:
+                with self._lock:
+                    changes, self._changes = self._changes, None
+
+            with self._lock:
+                if full:
+                    self._set_state(pers_no, dict((m.conference, m) for m in memberships),
+                                    unreads)
+                    self._synced_at = time.time()
+                else:
+                    self._unreads.update(unreads)
+                    self._stale_confs.difference_update(stale_confs)
+                for method, args in changes:
+                    method(*args)
+
+    def _membership_unread(self, conf_no):
+        unread_texts = sorted(self._unreads.get(conf_no, ()))
+        return KomMembershipUnread(self._pers_no, conf_no, len(unread_texts), unread_texts)
+
+    def _ordered_confs(self):
+        return sorted(self._memberships, key=lambda conf_no: self._memberships[conf_no].position)
+
+    def get_membership_unreads(self, ksession, pers_no):
+        """Same as KomSession.get_membership_unreads."""
+        self._sync(ksession, pers_no)
+        with self._lock:
+            return [ self._membership_unread(conf_no)
+                     for conf_no in self._ordered_confs() if self._unreads.get(conf_no) ]
+
+    def get_membership_unread(self, ksession, pers_no, conf_no):
+        """Same as KomSession.get_membership_unread, or None if
+        pers_no is not an active member of conf_no.
+        """
+        self._sync(ksession, pers_no)
+        with self._lock:
+            if conf_no not in self._memberships:
+                return None
+            return self._membership_unread(conf_no)
+
+    def get_unread_memberships(self, ksession, pers_no):
+        """Active memberships with unread texts, like
+        KomSession.get_memberships with unread=True.
+        """
+        self._sync(ksession, pers_no)
+        with self._lock:
+            return [ self._memberships[conf_no]
+                     for conf_no in self._ordered_confs() if self._unreads.get(conf_no) ]
+
+    def invalidate(self, conf_no=None):
+        """Fetch the membership (or all memberships if conf_no is None)
+        again the next time the tracker is used.
+        """
+        self._change(self._invalidate, conf_no)
+
+    def text_created(self, text_stat, text_no):
+        for mir in text_stat.misc_info.recipient_list:
+            self._change(self._add, mir.recpt, text_no)
+
+    def recipient_added(self, text_no, conf_no):
+        self._change(self._add, conf_no, text_no)
+
+    def recipient_removed(self, text_no, conf_no):
+        self._change(self._remove, conf_no, text_no)
+
+    def text_read(self, text_no):
+        """text_no has been marked as read in all recipients, or
+        deleted.
+        """
+        self._change(self._remove, None, text_no)
+
+    def _invalidate(self, conf_no):
+        if conf_no is None:
+            self._synced_at = None
+        elif conf_no in self._memberships:
+            self._stale_confs.add(conf_no)
+
+    def _add(self, conf_no, text_no):
+        if conf_no in self._memberships:
+            self._unreads.setdefault(conf_no, set()).add(text_no)
+
+    def _remove(self, conf_no, text_no):
+        if conf_no is None:
+            for unread_texts in self._unreads.values():
+                unread_texts.discard(text_no)
+        elif conf_no in self._unreads:
+            self._unreads[conf_no].discard(text_no)
+
+
+def attach_unread_tracker(ksession):
+    """Keep track of the session's unread texts. Does nothing for
+    sessions that are not owned by this process, or if
+    HTTPKOM_UNREAD_RESYNC_INTERVAL is 0.
+    """
+    client = pipelined_client(ksession)
+    interval = app.config['HTTPKOM_UNREAD_RESYNC_INTERVAL']
+    if not interval or client is None:
+        return
+
+    tracker = UnreadTracker(interval)
+    def deleted_text_handler(msg):
+        tracker.text_read(msg.text_no)
+    def new_text_handler(msg):
+        tracker.text_created(msg.text_stat, msg.text_no)
+    def new_recipient_handler(msg):
+        tracker.recipient_added(msg.text_no, msg.conf_no)
+    def sub_recipient_handler(msg):
+        tracker.recipient_removed(msg.text_no, msg.conf_no)
+    client.register_async_handler(AsyncMessages.DELETED_TEXT, deleted_text_handler,
+                                  skip_accept_async=True)
+    client.register_async_handler(AsyncMessages.NEW_TEXT, new_text_handler,
+                                  skip_accept_async=True)
+    client.register_async_handler(AsyncMessages.NEW_RECIPIENT, new_recipient_handler,
+                                  skip_accept_async=True)
+    client.register_async_handler(AsyncMessages.SUB_RECIPIENT, sub_recipient_handler)
+    client.unread_tracker = tracker
+
+
+def _tracker(ksession):
+    return getattr(pipelined_client(ksession), 'unread_tracker', None)
+
+def get_unread_tracker(ksession, pers_no):
+    """Return the session's UnreadTracker if it can answer for pers_no
+    (only the logged in person's unread texts are tracked), otherwise
+    None. Async messages that have arrived are handled first.
+    """
+    tracker = _tracker(ksession)
+    if tracker is None or pers_no != ksession.get_person_no():
+        return None
+    pipelined_client(ksession).handle_async_messages()
+    return tracker
+
+def unreads_text_read(ksession, text_no):
+    """Tell the session's tracker that text_no has been marked as read."""
+    tracker = _tracker(ksession)
+    if tracker is not None:
+        tracker.text_read(text_no)
+
+def invalidate_unreads(ksession, conf_no=None):
+    """See UnreadTracker.invalidate."""
+    tracker = _tracker(ksession)
+    if tracker is not None:
+        tracker.invalidate(conf_no)